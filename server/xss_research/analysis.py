@@ -0,0 +1,221 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+import pandas as pd
+
+from typing import Dict, Optional
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "xss_research_v2.db")
+LABELS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "framework-labels")
+FRAMEWORK_LABEL_FILES = ["xss-labeled-frameworks-1611967876.46879.csv", "new-xss-frameworks-done.csv"]
+ROUND2_UPDATES_FILE = "xss-framework-label-round2-updates.csv"
+FRAMEWORKS_OF_INTEREST = ['clientside_javascript', 'django', 'express', 'flask', 'go', 'java_and_jsp', 'javascript', 'rails', 'react']
+FINDING_COLUMNS = ["repo_url", "fix_commit", "previous_commit", "triage_status", "taxonomy"]
+LABEL_KEY = ["repo_url", "fix_commit"]
+
+# every finding with a framework label and its triage status after the
+# overrides; see FrameworkLabel for how a finding's label is chosen.
+LABELED_FINDINGS_QUERY = """
+SELECT repo_url, fix_commit, previous_commit, framework, coalesce(label_triage_status, triage_status) AS triage_status, taxonomy
+FROM (
+    SELECT f.id, f.repo_url, f.fix_commit, f.previous_commit, f.triage_status, f.taxonomy,
+        coalesce(
+            (SELECT l.framework FROM framework_label l
+             WHERE l.repo_url = f.repo_url AND l.fix_commit = f.fix_commit AND (:round2 OR NOT l.overrides)
+             ORDER BY l.precedence LIMIT 1),
+            (SELECT l.framework FROM framework_label l
+             WHERE l.repo_url = f.repo_url AND NOT l.overrides
+             ORDER BY l.precedence, l.position LIMIT 1)
+        ) AS framework,
+        (SELECT l.triage_status FROM framework_label l
+         WHERE :round2 AND l.repo_url = f.repo_url AND l.fix_commit = f.fix_commit AND l.overrides
+         ORDER BY l.precedence LIMIT 1) AS label_triage_status
+    FROM finding f
+)
+WHERE framework IS NOT NULL
+ORDER BY id
+"""
+
+def connect(db_file: str) -> sqlite3.Connection:
+    # read-only, so the analysis can run while the triage server writes.
+    return sqlite3.connect(f"file:{os.path.abspath(db_file)}?mode=ro", uri=True)
+
+def load_findings(db_file: str = DB_FILE) -> pd.DataFrame:
+    """The triage columns of every finding; diffs, notes and semgrep output are never read."""
+    conn = connect(db_file)
+    try:
+        findings = pd.read_sql_query(f"SELECT {', '.join(FINDING_COLUMNS)} FROM finding", conn)
+    finally:
+        conn.close()
+    # rename 'false_positive' to 'false_negative' due to naming error :3
+    findings["triage_status"] = findings["triage_status"].replace("false_positive", "false_negative")
+    return findings
+
+def load_framework_labels(labels_directory: str = LABELS_DIRECTORY) -> pd.DataFrame:
+    # the first label of a repository wins, for all of its commits.
+    frameworks = pd.concat(
+        [pd.read_csv(os.path.join(labels_directory, name), usecols=["repo_url", "framework"]) for name in FRAMEWORK_LABEL_FILES],
+        ignore_index=True,
+    )
+    return frameworks.drop_duplicates("repo_url")
+
+def load_label_updates(labels_directory: str = LABELS_DIRECTORY) -> pd.DataFrame:
+    updates = pd.read_csv(os.path.join(labels_directory, ROUND2_UPDATES_FILE), usecols=LABEL_KEY + ["framework", "triage_status"])
+    # like applying them one after the other: the last update of a commit wins.
+    return updates.drop_duplicates(LABEL_KEY, keep="last")
+
+def apply_label_updates(m: pd.DataFrame, updates: pd.DataFrame) -> pd.DataFrame:
+    """Overrides the framework and triage status of the commits in `updates`, joined on (repo_url, fix_commit)."""
+    merged = m.merge(updates, on=LABEL_KEY, how="left", suffixes=("", "_update"), indicator=True)
+    updated = merged["_merge"] == "both"
+    for column in ("framework", "triage_status"):
+        merged[column] = merged[column].where(~updated, merged[column + "_update"])
+    merged.index = m.index
+    return merged[list(m.columns)]
+
+def label_findings(findings: pd.DataFrame, labels_directory: str = LABELS_DIRECTORY, round2: bool = True) -> pd.DataFrame:
+    """
+    The notebook's `m`: every finding with its repository's framework, the
+    round 2 per-commit updates on top, and only confirmed XSS fixes
+    (true_positive: detected, false_negative: missed) of the frameworks of
+    interest.
+    """
+    m = load_framework_labels(labels_directory).merge(findings, on="repo_url").drop_duplicates(["fix_commit"])
+    m["triage_status"] = m["triage_status"].replace("false_positive", "false_negative")
+    if round2:
+        m = apply_label_updates(m, load_label_updates(labels_directory))
+    return select_fixes(m)
+
+def load_labeled_findings(db_file: str = DB_FILE, round2: bool = True) -> pd.DataFrame:
+    """
+    Like `label_findings`, with the labels imported into the database by
+    framework_labels.py and joined there, per commit where a commit has a
+    label of its own.
+    """
+    conn = connect(db_file)
+    try:
+        if not has_labels(conn):
+            raise SystemExit(f"No framework labels in '{db_file}'; import them with framework_labels.py first.")
+        m = pd.read_sql_query(LABELED_FINDINGS_QUERY, conn, params={"round2": round2})
+    finally:
+        conn.close()
+    m = m.drop_duplicates(["fix_commit"])
+    m["triage_status"] = m["triage_status"].replace("false_positive", "false_negative")
+    return select_fixes(m)
+
+def has_labels(conn: sqlite3.Connection) -> bool:
+    try:
+        return conn.execute("SELECT 1 FROM framework_label LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError:
+        # a database from before the framework_label table.
+        return False
+
+def select_fixes(m: pd.DataFrame) -> pd.DataFrame:
+    # drop anything that is 'unknown' or slated for deletion, and other frameworks.
+    m = m[m["triage_status"].isin(["true_positive", "false_negative"])]
+    return m.loc[m["framework"].isin(FRAMEWORKS_OF_INTEREST)]
+
+def detection_tables(m: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Every table of the paper from a single count of the labeled fixes by
+    framework, triage status and taxonomy:
+
+      summary    commits, repositories and the overall detection rate
+      p          fixes per framework and triage status (the notebook's `p`)
+      y          detection rate and N per framework (the notebook's `y`)
+      taxonomy   fixes per taxonomy and triage status
+    """
+    counts = m.groupby(["framework", "triage_status", "taxonomy"], dropna=False).size()
+    p = counts.groupby(level=["framework", "triage_status"]).sum().to_frame("fix_commit")
+    by_status = p["fix_commit"].unstack("triage_status", fill_value=0).reindex(columns=["false_negative", "true_positive"], fill_value=0)
+    n = by_status.sum(axis=1)
+    y = pd.DataFrame({"%": by_status["true_positive"] / n, "N": n}).sort_values(by="%", ascending=False)
+    taxonomy = counts.groupby(level=["taxonomy", "triage_status"], dropna=False).sum().unstack("triage_status", fill_value=0)
+    commits = int(n.sum())
+    summary = pd.Series({
+        "commits": commits,
+        "repos": m["repo_url"].nunique(),
+        "true_positive": int(by_status["true_positive"].sum()),
+        "false_negative": int(by_status["false_negative"].sum()),
+        "detection rate": by_status["true_positive"].sum() / commits if commits else 0.0,
+    }, dtype=object).to_frame("value")
+    return {"summary": summary, "p": p, "y": y, "taxonomy": taxonomy}
+
+def analyze(db_file: str = DB_FILE, labels_directory: Optional[str] = None, round2: bool = True) -> Dict[str, pd.DataFrame]:
+    """The tables from the imported labels, or joined from the CSVs in `labels_directory` the way the notebook does."""
+    if labels_directory is None:
+        return detection_tables(load_labeled_findings(db_file, round2))
+    return detection_tables(label_findings(load_findings(db_file), labels_directory, round2))
+
+def write_tables(tables: Dict[str, pd.DataFrame], output_directory: str):
+    os.makedirs(output_directory, exist_ok=True)
+    for name, table in tables.items():
+        table.to_csv(os.path.join(output_directory, name + ".csv"))
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Recomputes the detection rate tables of the paper from the triaged
+            findings and the framework labels, and prints them or writes each
+            one to a CSV file.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "-d",
+        "--database",
+        action="store",
+        required=False,
+        default=os.environ.get("RULE_STATS_DB", DB_FILE),
+        help="The triage database; RULE_STATS_DB by default, like the server."
+    )
+
+    args.add_argument(
+        "--labels-directory",
+        action="store",
+        required=False,
+        default=None,
+        help="Join the label CSVs in this directory by repository, like the notebook, instead of the labels imported\nwith framework_labels.py."
+    )
+
+    args.add_argument(
+        "--round1",
+        action="store_true",
+        required=False,
+        help="Don't apply the round 2 label updates, for the first version of the database."
+    )
+
+    args.add_argument(
+        "-o",
+        "--output-directory",
+        action="store",
+        required=False,
+        help="Write summary.csv, p.csv, y.csv and taxonomy.csv here instead of printing them."
+    )
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    start = time.monotonic()
+    tables = analyze(args.database, args.labels_directory, not args.round1)
+    logger.info(f"Computed the tables in {time.monotonic() - start:.2f} seconds")
+    if args.output_directory:
+        write_tables(tables, args.output_directory)
+        return
+    pd.set_option("display.width", 200)
+    for name, table in tables.items():
+        print(f"{name}:\n{table}\n")
+
+if __name__ == "__main__":
+    main()
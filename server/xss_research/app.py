@@ -1,11 +1,14 @@
+import collections
 import flask
 import logging
 import os
 import sys
 from urllib.parse import urlparse 
 from database import db
-from models import Finding, TriageStatus
-from typing import Any
+from models import FINDING_SORT_KEYS, DiffFile, Finding, FrameworkLabel, Taxonomy, TriageStatus, create_finding_fts, finding_framework
+from search import SEARCH_LIMIT, search_findings
+from metrics import METRICS_FILE, PERCENTILES, read_events, summarize
+from typing import Any, List
 
 from flask_migrate import Migrate
 
@@ -15,6 +18,9 @@ handler = logging.StreamHandler(stream=sys.stderr)
 handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger.addHandler(handler)
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
 def create_app() -> flask.Flask:
     app = flask.Flask(__name__)
     db_path = os.path.abspath(os.environ.get("RULE_STATS_DB", "../data/xss_research_v2.db"))
@@ -26,6 +32,7 @@ def create_app() -> flask.Flask:
 app = create_app()
 with app.app_context():
     db.create_all()
+    create_finding_fts(db.engine)
 migrate = Migrate(app, db)
 
 @app.errorhandler(404)
@@ -34,8 +41,94 @@ def handler_not_found(exc: Any) -> Any:
 
 @app.route('/', methods=["GET"])
 def index() -> flask.Response():
-    findings: List[Finding] = Finding.query.order_by(Finding.triage_status.desc()).all()
-    return flask.render_template("index.html", findings=findings)
+    args = flask.request.args
+    sort = args.get("sort", "triage_status")
+    if sort not in FINDING_SORT_KEYS:
+        flask.abort(400)
+    descending = args.get("order", "desc") == "desc"
+    limit = max(1, min(args.get("limit", PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    key = FINDING_SORT_KEYS[sort]
+
+    # only the listed columns; diffs and notes can be megabytes each.
+    query = db.session.query(
+        Finding.id,
+        Finding.repo_url,
+        Finding.triage_status,
+        Finding.taxonomy,
+        finding_framework().label("framework"),
+        db.func.substr(Finding.reviewer_notes, 1, 100).label("reviewer_notes"),
+        key.label("sort_key"),
+    )
+    query = filter_findings(query, args)
+
+    # keyset pagination: continue after the last (key, id) of the previous page.
+    after_id = args.get("after_id", type=int)
+    if after_id is not None:
+        after = args.get("after", "")
+        # spelled out rather than as a row value comparison, which SQLite
+        # can't turn into an index range.
+        if descending:
+            query = query.filter(key <= after, db.or_(key < after, Finding.id < after_id))
+        else:
+            query = query.filter(key >= after, db.or_(key > after, Finding.id > after_id))
+    if descending:
+        query = query.order_by(key.desc(), Finding.id.desc())
+    else:
+        query = query.order_by(key.asc(), Finding.id.asc())
+    findings = query.limit(limit + 1).all()
+
+    next_page = None
+    if len(findings) > limit:
+        findings = findings[:limit]
+        next_page = dict(args.items(), after=findings[-1].sort_key, after_id=findings[-1].id)
+    return flask.render_template("index.html",
+        findings=findings,
+        args=args,
+        sort=sort,
+        descending=descending,
+        next_page=next_page,
+        triage_statuses=TriageStatus,
+        taxonomies=Taxonomy,
+        frameworks=[framework for framework, in db.session.query(FrameworkLabel.framework).filter(
+            FrameworkLabel.framework.isnot(None)).distinct().order_by(FrameworkLabel.framework)],
+    )
+
+def filter_findings(query, args):
+    triage_status = args.get("triage_status")
+    if triage_status:
+        if triage_status not in TriageStatus.__members__:
+            flask.abort(400)
+        query = query.filter(FINDING_SORT_KEYS["triage_status"] == triage_status)
+    taxonomy = args.get("taxonomy")
+    if taxonomy:
+        if taxonomy != "none" and taxonomy not in Taxonomy.__members__:
+            flask.abort(400)
+        query = query.filter(FINDING_SORT_KEYS["taxonomy"] == ("" if taxonomy == "none" else taxonomy))
+    framework = args.get("framework")
+    if framework:
+        # labeled in framework_label by framework_labels.py; 'none' is unlabeled.
+        query = query.filter(finding_framework().is_(None) if framework == "none" else finding_framework() == framework)
+    repo = args.get("repo", "").strip()
+    if repo:
+        if not repo.startswith("http"):
+            repo = "https://github.com/" + repo.lstrip("/")
+        # a range instead of LIKE, so the repo_url index is used.
+        query = query.filter(Finding.repo_url >= repo, Finding.repo_url < repo + "\U0010ffff")
+    return query
+
+@app.route('/search', methods=["GET"])
+def search() -> flask.Response():
+    query = flask.request.args.get("q", "").strip()
+    limit = max(1, min(flask.request.args.get("limit", SEARCH_LIMIT, type=int), MAX_PAGE_SIZE))
+    results = search_findings(query, limit) if query else []
+    return flask.render_template("search.html", query=query, results=results)
+
+@app.route('/metrics', methods=["GET"])
+def metrics() -> flask.Response():
+    # the file the pipeline scripts append to, read as is.
+    path = os.path.abspath(os.environ.get("PIPELINE_METRICS", METRICS_FILE))
+    summary = summarize(read_events(path)) if os.path.exists(path) else None
+    return flask.render_template("metrics.html", path=path, summary=summary, percentiles=PERCENTILES)
 
 @app.route('/login')
 def login() -> flask.Response():
@@ -48,7 +141,6 @@ def logout() -> flask.Response():
 @app.route('/details/<int:finding_id>', methods=["GET"])
 def details(finding_id: int) -> flask.Response():
     finding = Finding.query.filter(Finding.id == finding_id).first()
-    logger.debug(finding.diff_text)
 
     repo_url_path = urlparse(finding.repo_url).path.lstrip("/")
     taxonomy = finding.taxonomy.name if finding.taxonomy else "A"
@@ -56,14 +148,54 @@ def details(finding_id: int) -> flask.Response():
         repo_url=finding.repo_url,
         repo_url_path=repo_url_path,
         repo_message=finding.repo_message,
-        diffstring=finding.diff_text,
         fix_commit=finding.fix_commit,
         previous_commit=finding.previous_commit,
         semgrep_results_on_diff=finding.semgrep_results_on_diff,
+        ruleset_hash=finding.ruleset_hash,
+        matches=finding.matches,
         triage_status=finding.triage_status.value,
         reviewer_notes=finding.reviewer_notes,
         taxonomy=taxonomy,
         finding_id=finding_id,
+        canonical=finding.canonical,
+        duplicates=finding.duplicates,
+    )
+
+def diff_files_for(finding: Finding) -> List[DiffFile]:
+    # findings stored before diffs were indexed get their index on first view.
+    if not finding.diff_files and finding.diff_hash is not None:
+        finding.diff_files = DiffFile.from_diff(finding.diff_text)
+        db.session.commit()
+    return finding.diff_files
+
+@app.route('/details/<int:finding_id>/files', methods=["GET"])
+def diff_files(finding_id: int) -> flask.Response():
+    finding = Finding.query.get_or_404(finding_id)
+    matches_per_path = collections.Counter(match.path for match in finding.matches)
+    files = []
+    for diff_file in diff_files_for(finding):
+        files.append({
+            "position": diff_file.position,
+            "path": diff_file.path,
+            "old_path": diff_file.old_path,
+            "additions": diff_file.additions,
+            "deletions": diff_file.deletions,
+            "size": diff_file.length,
+            # matches are on the old side of the diff.
+            "matches": matches_per_path.get(diff_file.old_path, 0),
+        })
+    # files with semgrep matches first, otherwise in diff order.
+    files.sort(key=lambda file: (file["matches"] == 0, file["position"]))
+    return flask.jsonify(files=files)
+
+@app.route('/details/<int:finding_id>/files/<int:position>', methods=["GET"])
+def diff_file(finding_id: int, position: int) -> flask.Response():
+    finding = Finding.query.get_or_404(finding_id)
+    diff_files_for(finding)
+    diff_file = DiffFile.query.filter(DiffFile.finding_id == finding_id, DiffFile.position == position).first_or_404()
+    return flask.jsonify(
+        path=diff_file.path,
+        diff=finding.diff_text[diff_file.start:diff_file.start + diff_file.length],
     )
 
 @app.route('/update/<int:finding_id>', methods=["POST"])
@@ -79,7 +211,16 @@ def update(finding_id: int) -> flask.Response():
     if taxonomy:
         updates["taxonomy"] = taxonomy
 
-    db.session.query(Finding).filter(Finding.id == finding_id).update(updates)
+    # set on the object rather than as a bulk update, so the search index follows.
+    finding = Finding.query.get_or_404(finding_id)
+    for key, value in updates.items():
+        setattr(finding, key, value)
+    # the same fix in forks, mirrors and cherry-picks shares one triage decision.
+    root = finding.canonical or finding
+    for other in [root] + root.duplicates:
+        for key in ("triage_status", "taxonomy"):
+            if key in updates and other is not finding:
+                setattr(other, key, updates[key])
     db.session.commit()
 
     return flask.redirect(flask.url_for("details", finding_id=finding_id))
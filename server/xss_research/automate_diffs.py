@@ -1,16 +1,26 @@
 import argparse
 import json
 import logging
-import pandas as pd
 import os
-import requests
-import subprocess
 import sys
-import math
-from sqlalchemy.orm.exec import MultipleResultsFound
+import shutil
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from sqlalchemy.exc import IntegrityError
 from app import app
-from models import Finding, TriageStatus
-from util import cwd, git_checkout
+from models import DiffFile, Finding, SemgrepMatch, TriageStatus
+from util import WORKTREE_DIRECTORY, WorktreeManager
+from mirrors import MirrorCache, add_mirror_args, directory_size, mirror_cache_from_args
+from records import read_records
+from ledger import DIFF, DONE, DOWNLOAD, FAILED, PERSIST, SEMGREP, SKIPPED, Ledger, add_ledger_args, is_selected
+from hunks import DEFAULT_HUNK_CONTEXT, HunkIndex, classify_results
+from changes import ChangeSummary, get_change_summary
+from gitobjects import repository
+from limits import Limits, add_limit_args, get_limits, limits_from_args, run_git, set_limits
+from metrics import add_metrics_args, emit, get_metrics_file, set_metrics_file, timed
+from semgrep_cache import SEMGREP_CACHE_FILE, SemgrepCache, load_rules
+from rulesets import PACK_URL, RulesetStore, add_ruleset_args, ruleset_from_args, ruleset_hash
+from semgrep_batch import DEFAULT_BATCH_MAX_BYTES, DEFAULT_BATCH_SIZE, SemgrepBatch
 from database import db
 
 logger = logging.getLogger(__file__)
@@ -19,26 +29,9 @@ handler = logging.StreamHandler(stream=sys.stderr)
 handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger.addHandler(handler)
 
-DOWNLOADED_REPO_DIRECTORY = "downloaded_repos"
-PACK_URL = "https://semgrep.dev/c/p/xss"
-LOCAL_RULESET_FILE = os.path.join(os.getcwd(), "semgrep.yaml")
-LEN_CMD = 3
-
-SUPPORTED_LANG_EXTS_XSS = [
-    ".go",
-    ".java",
-    ".js",
-    ".json",
-    ".py",
-    ".rb",
-    ".ts",
-    ".jsx",
-    ".tsx",
-    ".html",
-    ".erb",
-    ".jsp",
-    ".yml"
-]
+DEFAULT_DB_BATCH_SIZE = 100
+# rows buffered per worker, out of which the most expensive one is started next.
+SCHEDULE_WINDOW_PER_JOB = 8
 
 with app.app_context():
     db.create_all()
@@ -57,8 +50,8 @@ def parse_args():
         "-i",
         "--input",
         action="store",
-        required=True,
-        help="The JSON file containing information on bigQuery results."
+        required=False,
+        help="The records written by get_parents.py, either one JSON object per line or the older split-oriented table. Use '-' for stdin. Without it, --retry-failed re-runs the failed records in the ledger."
     )
 
     args.add_argument(
@@ -68,155 +61,501 @@ def parse_args():
         help="Only run semgrep on the diffs between the two commits."
     )
 
-    return args.parse_args()
+    args.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of worker processes used to clone, diff and scan repositories in parallel."
+    )
 
-def download_ruleset(ruleset_url: str, download_path: str = LOCAL_RULESET_FILE) -> str:
-    logger.info(f"Downloading ruleset '{ruleset_url}' to file '{download_path}'")
-    with open(download_path, 'w') as fout:
-        fout.write(requests.get(ruleset_url).text)
-    return os.path.abspath(download_path)
+    args.add_argument(
+        "--semgrep-cache",
+        action="store",
+        required=False,
+        default=SEMGREP_CACHE_FILE,
+        help="SQLite file caching semgrep matches per file blob and rule, shared across runs."
+    )
 
-def download_repo(row, path: str):
-    repo_name = row["repository"]
-    git_url = "https://github.com/" + repo_name + ".git"
-    logger.info(f"Downloading repo '{git_url}'")
-    # download repositories and semgrep diff/ git diff them
-    with cwd(DOWNLOADED_REPO_DIRECTORY):
-        subprocess.run(["git", "clone", git_url, repo_name])
+    args.add_argument(
+        "--batch-size",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of findings whose files are scanned together in one semgrep run."
+    )
 
-def get_diff_text(path: str, old_commit: str, new_commit: str) -> str:
+    args.add_argument(
+        "--batch-max-mb",
+        action="store",
+        type=float,
+        required=False,
+        default=DEFAULT_BATCH_MAX_BYTES / 1024 ** 2,
+        help="Scan a batch early once the files waiting to be scanned add up to this many megabytes."
+    )
+
+    args.add_argument(
+        "--hunk-context",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_HUNK_CONTEXT,
+        help="Matches within this many lines of a changed hunk are kept as near the fix."
+    )
+
+    args.add_argument(
+        "--keep-unrelated",
+        action="store_true",
+        required=False,
+        help="Also store matches that are nowhere near the lines the fix changed."
+    )
+
+    args.add_argument(
+        "--db-batch-size",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_DB_BATCH_SIZE,
+        help="Number of findings inserted into the database per transaction."
+    )
+
+    add_mirror_args(args)
+    add_ledger_args(args)
+    add_ruleset_args(args)
+    add_limit_args(args)
+    add_metrics_args(args)
+
+    return args.parse_args()
+
+def get_diff(path: str, old_commit: str, new_commit: str):
     logger.info(f"Running git diff on '{path}'")
-    with cwd(path):
-        p = subprocess.run(["git", "--no-pager", "diff", old_commit, new_commit], capture_output=True)
-        if p.returncode != 0:
-            return "git diff run returned an error."
-        diff_text = p.stdout
+    p = run_git(["--no-pager", "diff", "--no-color", "--no-ext-diff", "--src-prefix=a/", "--dst-prefix=b/", old_commit, new_commit], path)
+    if type(p) == str:
+        return p
+    if p.returncode != 0:
+        return "git diff run returned an error."
+    return p.stdout
+
+def decode_diff(diff: bytes) -> str:
     try:
-        return diff_text.decode('utf-8')
+        return diff.decode('utf-8')
     except UnicodeDecodeError:
         return "Couldn't decode git diff output."
 
-def get_git_diff_files(path: str, old_commit: str, new_commit: str):
-    with cwd(path):
-        p = subprocess.run(["git", "diff", "--name-only", old_commit, new_commit], stdout=subprocess.PIPE)
-        if p.returncode != 0:
-            return "git diff for files only returned an error."
-        try:
-            git_diff_files = p.stdout.decode('utf-8')
-        except UnicodeDecodeError:
-            return "Couldn't decode git diff files."
-
-    git_diff_list = list(git_diff_files.split("\n"))
-    if len(git_diff_list) > 0:
-        git_diff_list = git_diff_list[:-1]
-    return git_diff_list
-
-def lang_supported(git_diff_files: list) -> bool:
-    # if more than 20% of files is of an extension we don't support, skip.
-    unsupported_files = 0
-    max_unsupported_files = math.floor(len(git_diff_files)/5)
-    for file in git_diff_files:
-        filename, file_extension = os.path.splitext(file)
-        if not file_extension in SUPPORTED_LANG_EXTS_XSS:
-            unsupported_files += 1
-        if unsupported_files > max_unsupported_files:
-            logger.info(f"This repository has {unsupported_files} file(s) in languages that are not supported.")
-            return False
-    return True
-
-def get_semgrep_results(path: str, old_commit: str, new_commit: str) -> str:
-    git_diff_list = get_git_diff_files(path, old_commit, new_commit)
-    # if git diff list doesn't return error, run lang_supported.
-    if (type(git_diff_list) != str):
-        if (not lang_supported(git_diff_list)):
-            return "Not Supported."
-    with cwd(path):
-        with git_checkout(old_commit):
-            p = subprocess.run(["semgrep", "-f", LOCAL_RULESET_FILE], stdout=subprocess.PIPE)
-            try:
-                results = p.stdout.decode('utf-8')
-            except UnicodeDecodeError:
-                return "Could not decode git diff output."
-    return results
-
-def get_semgrep_results_for_changed_files(path: str, old_commit: str, new_commit: str)-> str:
-    # get files that had diffs.
-    logger.info(f"Running Semgrep on '{path}'")
-    git_diff_list = get_git_diff_files(path, old_commit, new_commit)
-    if (not lang_supported(git_diff_list)):
-        return "Not Supported."
-
-    with cwd(path):
-        with git_checkout(old_commit):
-            cmd = ['semgrep', '--config', LOCAL_RULESET_FILE]
-            for file_name in git_diff_list:
-                file_name = file_name.strip()
-                # check if the file exists in the old directory
-                if os.path.exists(file_name):
-                    cmd.append(file_name)
-            if (len(cmd) == LEN_CMD):
-                return "Only added files diff'ed."
-            p = subprocess.run(cmd, stdout=subprocess.PIPE)
-            if p.returncode != 0:
-                return "semgrep run returned an error."
-    try:
-        return p.stdout.decode('utf-8')
-    except UnicodeDecodeError:
-        return "Couldn't decode semgrep output."
+def get_diff_text(path: str, old_commit: str, new_commit: str) -> str:
+    diff = get_diff(path, old_commit, new_commit)
+    if type(diff) == str:
+        return diff
+    return decode_diff(diff)
 
-def post_to_db(row, git_diff_text: str, semgrep_diff_text: str):
-    repo_name = row["repository"]
-    repo_url = "https://github.com/" + repo_name
-    row_to_add = Finding(
-        repo_url=repo_url,
+def get_blobs(path: str, commit: str, file_names: list = None):
+    # maps each regular file of `commit` (or only `file_names`) to its blob hash,
+    # read through the repository's shared `git cat-file` processes.
+    blobs = repository(path).files(commit, file_names)
+    if blobs is None:
+        return "git ls-tree returned an error."
+    return blobs
+
+def get_semgrep_targets(path: str, old_commit: str):
+    return get_blobs(path, old_commit)
+
+def get_semgrep_targets_for_changed_files(path: str, old_commit: str, changes: ChangeSummary):
+    # only changed files that exist in the old commit, under their old names.
+    blobs = get_blobs(path, old_commit, changes.old_paths())
+    if type(blobs) == str:
+        return blobs
+    if len(blobs) == 0:
+        return "Only added files diff'ed."
+    return blobs
+
+def repo_url_for(row) -> str:
+    return "https://github.com/" + row["repository"]
+
+def make_finding(row, git_diff_text: str, semgrep_results, ruleset_hash: str = None) -> Finding:
+    # semgrep_results is either semgrep's JSON results, stored as SemgrepMatch
+    # rows, or a message saying why there are none.
+    finding = Finding(
+        repo_url=repo_url_for(row),
         repo_message=row["message"],
         fix_commit=row["commit"],
         previous_commit= row["parent"][0],
         diff_text=git_diff_text,
-        semgrep_results_on_diff=semgrep_diff_text,
+        semgrep_results_on_diff=semgrep_results if type(semgrep_results) == str else None,
         triage_status=TriageStatus(0),
         reviewer_notes="",
+        ruleset_hash=ruleset_hash,
+        patch_id=row.get("patch_id"),
     )
+    if type(semgrep_results) != str:
+        finding.matches = [SemgrepMatch.from_semgrep_result(result) for result in semgrep_results]
+    finding.diff_files = DiffFile.from_diff(git_diff_text)
+    return finding
+
+def post_to_db(findings: list):
+    """Inserts a batch of findings in one transaction."""
+    if not findings:
+        return
     with app.app_context():
-        db.session.add(row_to_add)
-        db.session.commit()
-
-def analyze_repos(table, diffs_only: bool):
-    download_ruleset(PACK_URL, LOCAL_RULESET_FILE)
-    for index, row in table.iterrows():
-        repo_name = row["repository"]
-        repo_path = os.path.join(DOWNLOADED_REPO_DIRECTORY, repo_name)
-        repo_url = "https://github.com/" + repo_name
-        # first check if repo already in db. If it is, skip.
-        with app.app_context():
+        db.session.add_all(findings)
+        try:
+            db.session.commit()
+            return
+        except IntegrityError:
+            # another run inserted some of these since the keys were loaded.
+            db.session.rollback()
+        for finding in findings:
+            db.session.add(finding)
             try:
-                repo_exists = db.session.query(Finding.id).filter(
-                    Finding.repo_url==repo_url,
-                    Finding.fix_commit==row["commit"]).scalar()
-            except MultipleResultsFound:
-                repo_exists = 1
-        if not repo_exists is None:
-            logger.info(f"Skipping '{repo_name} because it is already in the database.")
-            continue
-        if not os.path.exists(repo_path):
-            logger.info(f"Repository '{repo_name}' has not been downloaded. Downloading...")
-            logger.info(f"Creating directory '{repo_path}'")
-            os.makedirs(repo_path)
-            download_repo(row, repo_path)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                logger.info(f"Skipping '{finding.repo_url}' commit '{finding.fix_commit}' because it is already in the database.")
 
-        git_diff_text = get_diff_text(repo_path, row["parent"][0], row["commit"])
+def existing_findings() -> set:
+    """Returns the (repo_url, fix_commit) of every finding already in the database."""
+    with app.app_context():
+        return set(db.session.query(Finding.repo_url, Finding.fix_commit))
+
+def prepare_row(row, diffs_only: bool, mirrors: MirrorCache, cache: SemgrepCache, ruleset_file: str):
+    # runs in a worker process when --jobs > 1, so this must never touch the database.
+    repo_name = row["repository"]
+    # clones the repository if it isn't cached yet, and fetches the commits if they're missing.
+    prepared = {
+        "row": row,
+        # (stage, reason) if the row can't be analyzed.
+        "failure": None,
+        "changes": None,
+        "diff_text": None,
+        "hunks": None,
+        "targets": None,
+        "worktrees": None,
+        "worktree_path": None,
+        "scan_bytes": 0,
+    }
+    with timed("clone", repo_name) as metrics:
+        size = mirror_bytes(mirrors.path_for(repo_name))
+        repo_path = mirrors.ensure(repo_name, [row["parent"][0], row["commit"]])
+        metrics["bytes"] = mirror_bytes(mirrors.path_for(repo_name)) - size
+    if repo_path is None:
+        logger.info(f"Skipping '{repo_name}' because it could not be downloaded.")
+        prepared["failure"] = (DOWNLOAD, "Repository could not be downloaded.")
+        return prepared
+    for commit in (row["parent"][0], row["commit"]):
+        if not mirrors.has_commit(repo_path, commit):
+            logger.info(f"Skipping '{repo_name}' commit '{row['commit']}': '{commit}' could not be fetched.")
+            prepared["failure"] = (DOWNLOAD, "Commit does not exist in the repository.")
+            return prepared
+
+    # the blobs of a blobless mirror are fetched by the diff, so its growth is counted too.
+    with timed("git diff", repo_name) as metrics:
+        size = mirror_bytes(repo_path)
+        # what changed decides whether the commit is analyzed at all, before the full diff and any checkout.
+        changes = get_change_summary(repo_path, row["parent"][0], row["commit"])
+        if type(changes) == str:
+            prepared["failure"] = (DIFF, changes)
+            return prepared
+        prepared["changes"] = changes
+        metrics["changed_lines"] = changes.lines
+        if not changes.supported():
+            logger.info(f"Skipping '{repo_name}' commit '{row['commit']}': {changes.unsupported_fraction():.0%} of the changed lines are in languages that are not supported.")
+            prepared["targets"] = "Not Supported."
+            return prepared
+        diff = get_diff(repo_path, row["parent"][0], row["commit"])
+        if type(diff) == str:
+            prepared["failure"] = (DIFF, diff)
+            return prepared
+        # the hunks come out of the same diff, rather than a second `git diff -U0`.
+        hunks = HunkIndex.from_diff(diff)
+        git_diff_text = decode_diff(diff)
         if diffs_only:
-            semgrep_diff_text = get_semgrep_results_for_changed_files(repo_path, row["parent"][0], row["commit"])
+            targets = get_semgrep_targets_for_changed_files(repo_path, row["parent"][0], changes)
         else:
-            semgrep_diff_text = get_semgrep_results(repo_path, row["parent"][0], row["commit"])
-        if not semgrep_diff_text == "Not Supported.":
-            post_to_db(row, git_diff_text, semgrep_diff_text)
+            targets = get_semgrep_targets(repo_path, row["parent"][0])
+        metrics["bytes"] = mirror_bytes(repo_path) - size
+    prepared["diff_text"] = git_diff_text
+    prepared["hunks"] = hunks
+    prepared["targets"] = targets
+    if type(targets) == str:
+        return prepared
+
+    # the old commit is only checked out if some of its files aren't in the semgrep cache.
+    missing = cache.missing_rules(targets, load_rules(ruleset_file))
+    emit("semgrep cache", repo_name, files=len(targets), hits=len(targets) - len(missing))
+    if missing:
+        # every finding gets its own worktree so it survives until its batch is scanned.
+        worktrees = WorktreeManager(repo_path, root=os.path.join(WORKTREE_DIRECTORY, uuid.uuid4().hex), name=repo_name)
+        worktree_path = worktrees.checkout(row["parent"][0])
+        if worktree_path is None:
+            release_worktrees(worktrees)
+            prepared["targets"] = "git worktree add returned an error."
+            return prepared
+        prepared["worktrees"] = worktrees
+        prepared["worktree_path"] = worktree_path
+        prepared["scan_bytes"] = sum(os.path.getsize(os.path.join(worktree_path, path)) for path in missing)
+    return prepared
+
+def mirror_bytes(path: str) -> int:
+    return directory_size(path) if os.path.exists(path) else 0
+
+def release_worktrees(worktrees: WorktreeManager):
+    worktrees.close()
+    shutil.rmtree(os.path.dirname(worktrees.root), ignore_errors=True)
+
+def estimated_cost(row, mirrors: MirrorCache, mirror_sizes: dict) -> float:
+    # in arbitrary units where a megabyte of history weighs as much as a changed
+    # file: big histories are slow to diff and check out, and every changed file
+    # is another file to scan.
+    repo_name = row["repository"]
+    if repo_name not in mirror_sizes:
+        path = mirrors.path_for(repo_name)
+        if not os.path.exists(path):
+            # not cloned yet; measured again once it is.
+            return row.get("changed_files", 0)
+        mirror_sizes[repo_name] = directory_size(path) / 1024 ** 2
+    return mirror_sizes[repo_name] + row.get("changed_files", 0)
+
+def init_worker(limits: Limits, metrics_file: str):
+    # worker processes run their git and semgrep processes under the same
+    # limits, and append to the same metrics file.
+    set_limits(limits)
+    set_metrics_file(metrics_file)
+
+def failed_row(row, e: Exception) -> dict:
+    logger.exception(f"Analyzing a commit of '{row['repository']}' failed.")
+    return {"row": row, "failure": (DIFF, f"{type(e).__name__}: {e}")}
+
+def prepare_rows_serially(rows, diffs_only: bool, mirrors: MirrorCache, cache: SemgrepCache, ruleset_file: str):
+    # a commit that fails is marked in the ledger like with -j N instead of ending the run.
+    for row in rows:
+        try:
+            yield prepare_row(row, diffs_only, mirrors, cache, ruleset_file)
+        except Exception as e:
+            yield failed_row(row, e)
+
+def prepare_rows_in_parallel(rows, diffs_only: bool, mirrors: MirrorCache, cache: SemgrepCache, jobs: int,
+                             ruleset_file: str):
+    # Rows are started longest job first out of a window of buffered rows, so
+    # the giant repositories start early instead of being what the whole run
+    # waits on at the end. Rows of the same repository share one clone, so at
+    # most one of them is in flight at a time.
+    busy_repos = set()
+    window = []
+    in_flight = {}
+    mirror_sizes = {}
+    rows = iter(rows)
+    exhausted = False
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(get_limits(), get_metrics_file())) as executor:
+        while True:
+            # keep a bounded number of rows buffered so large inputs aren't read all at once.
+            while not exhausted and len(window) + len(in_flight) < SCHEDULE_WINDOW_PER_JOB * jobs:
+                row = next(rows, None)
+                if row is None:
+                    exhausted = True
+                    break
+                window.append((estimated_cost(row, mirrors, mirror_sizes), row))
+            while len(in_flight) < jobs:
+                startable = [i for i, (cost, row) in enumerate(window) if row["repository"] not in busy_repos]
+                if not startable:
+                    break
+                # the first of equally expensive rows keeps the input order.
+                cost, row = window.pop(max(startable, key=lambda i: window[i][0]))
+                busy_repos.add(row["repository"])
+                in_flight[executor.submit(prepare_row, row, diffs_only, mirrors, cache, ruleset_file)] = row
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                row = in_flight.pop(future)
+                repo_name = row["repository"]
+                busy_repos.discard(repo_name)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield failed_row(row, e)
+
+def rows_to_analyze(records, existing: set, ledger: Ledger, retry_failed: bool):
+    for row in records:
+        # first check if repo already in db. If it is, skip.
+        key = (repo_url_for(row), row["commit"])
+        if key in existing:
+            logger.info(f"Skipping '{row['repository']}' because it is already in the database.")
+            continue
+        # then whether an earlier run finished it, skipped it or (unless retrying) failed on it.
+        if not is_selected(ledger.get(row["repository"], row["commit"]), retry_failed):
+            continue
+        # the same commit listed twice in the input is only analyzed once.
+        existing.add(key)
+        yield row
+
+def canonical_patch_ids() -> set:
+    """The patch ids of the stored findings that duplicates are linked to."""
+    with app.app_context():
+        query = db.session.query(Finding.patch_id).filter(Finding.patch_id.isnot(None), Finding.canonical_id.is_(None))
+        return {patch_id for patch_id, in query}
+
+def deduplicated_rows(rows, representatives: dict, duplicates: list):
+    # of the rows with the same patch id (see dedup.py) only the first is
+    # analyzed; the others wait in `duplicates` until its finding is stored.
+    for row in rows:
+        patch_id = row.get("patch_id")
+        if patch_id is None:
+            yield row
+            continue
+        if patch_id in representatives:
+            duplicates.append(row)
+            continue
+        representatives[patch_id] = (row["repository"], row["commit"])
+        yield row
+
+def make_duplicate_finding(row, canonical: Finding) -> Finding:
+    return Finding(
+        repo_url=repo_url_for(row),
+        repo_message=row["message"],
+        fix_commit=row["commit"],
+        previous_commit=row["parent"][0],
+        patch_id=row["patch_id"],
+        canonical_id=canonical.id,
+        triage_status=canonical.triage_status,
+        taxonomy=canonical.taxonomy,
+        reviewer_notes="",
+    )
+
+def link_duplicates(duplicates: list, ledger: Ledger) -> list:
+    """Stores the duplicates whose canonical finding is stored, linked to it; returns the ones still waiting."""
+    if not duplicates:
+        return duplicates
+    with app.app_context():
+        patch_ids = sorted({row["patch_id"] for row in duplicates})
+        canonical = {}
+        for i in range(0, len(patch_ids), 500):
+            query = Finding.query.filter(Finding.patch_id.in_(patch_ids[i:i + 500]), Finding.canonical_id.is_(None))
+            canonical.update((finding.patch_id, finding) for finding in query)
+        linked = [row for row in duplicates if row["patch_id"] in canonical]
+        findings = [make_duplicate_finding(row, canonical[row["patch_id"]]) for row in linked]
+    if linked:
+        logger.info(f"Linking {len(linked)} duplicate fix(es) to their analyzed finding")
+        persist(linked, findings, ledger)
+    return [row for row in duplicates if row["patch_id"] not in canonical]
+
+def settle_unlinked_duplicates(duplicates: list, representatives: dict, ledger: Ledger):
+    # the analyzed commit was skipped or failed: its duplicates end up the same
+    # way, and a failed one is retried with --retry-failed like any other.
+    for row in duplicates:
+        # None if the finding of an earlier run was deleted since.
+        repository, commit = representatives[row["patch_id"]] or (None, None)
+        state = ledger.get(repository, commit) if repository is not None else None
+        if state is not None and state["status"] == SKIPPED:
+            ledger.mark(row["repository"], row["commit"], state["stage"], SKIPPED, state["reason"], record=row)
+        else:
+            reason = f"The same fix in '{repository}' commit '{commit}' wasn't analyzed." if repository else "The finding of the same fix was deleted."
+            ledger.mark(row["repository"], row["commit"], state["stage"] if state is not None else DIFF, FAILED, reason, record=row)
+
+def scan_prepared_rows(prepared_rows, batch: SemgrepBatch):
+    for prepared in prepared_rows:
+        if prepared["failure"] is not None or type(prepared["targets"]) == str:
+            yield prepared, prepared.get("targets")
+            continue
+        for finished, results in batch.add(prepared):
+            yield finish_prepared_row(finished, results)
+    for finished, results in batch.flush():
+        yield finish_prepared_row(finished, results)
+
+def finish_prepared_row(prepared, results):
+    if prepared["worktrees"] is not None:
+        release_worktrees(prepared["worktrees"])
+    return prepared, results
+
+def persist(rows: list, findings: list, ledger: Ledger):
+    with timed("db write", findings=len(findings)):
+        post_to_db(findings)
+    ledger.mark_many([(row["repository"], row["commit"]) for row in rows], PERSIST, DONE)
+
+def analyze_repos(records, diffs_only: bool, mirrors: MirrorCache, cache: SemgrepCache, ledger: Ledger, jobs: int = 1,
+                  batch_size: int = DEFAULT_BATCH_SIZE, batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+                  hunk_context: int = DEFAULT_HUNK_CONTEXT, keep_unrelated: bool = False,
+                  db_batch_size: int = DEFAULT_DB_BATCH_SIZE, retry_failed: bool = False, limits: Limits = None,
+                  ruleset_file: str = None):
+    if limits is not None:
+        set_limits(limits)
+    if ruleset_file is None:
+        store = RulesetStore()
+        ruleset_file = store.path_for(store.current(PACK_URL))
+    # recorded on every finding, so results stay attributable when the pack changes.
+    current_ruleset_hash = ruleset_hash(ruleset_file)
+    logger.info(f"Scanning with ruleset {current_ruleset_hash[:12]} ({ruleset_file})")
+    # records are read lazily, so analysis starts before get_parents.py is done writing them.
+    rows = rows_to_analyze(records, existing_findings(), ledger, retry_failed)
+    # findings stored by earlier runs represent their patch id already.
+    representatives = {patch_id: None for patch_id in canonical_patch_ids()}
+    duplicates = []
+    rows = deduplicated_rows(rows, representatives, duplicates)
+    if jobs > 1:
+        prepared_rows = prepare_rows_in_parallel(rows, diffs_only, mirrors, cache, jobs, ruleset_file)
+    else:
+        prepared_rows = prepare_rows_serially(rows, diffs_only, mirrors, cache, ruleset_file)
+    # the files of many findings are scanned together in one semgrep run.
+    batch = SemgrepBatch(cache, load_rules(ruleset_file), WORKTREE_DIRECTORY, batch_size, batch_max_bytes)
+    # only this (the main) process writes to the database and the ledger, a batch at a time.
+    rows = []
+    findings = []
+    for prepared, semgrep_results in scan_prepared_rows(prepared_rows, batch):
+        row = prepared["row"]
+        if prepared["failure"] is not None:
+            stage, reason = prepared["failure"]
+            ledger.mark(row["repository"], row["commit"], stage, FAILED, reason, record=row)
+            continue
+        if semgrep_results == "Not Supported.":
+            ledger.mark(row["repository"], row["commit"], DIFF, SKIPPED, semgrep_results, record=row)
+            continue
+        if type(semgrep_results) == str and semgrep_results != "Only added files diff'ed.":
+            # git or semgrep errors; the row is retried by --retry-failed instead of being stored.
+            ledger.mark(row["repository"], row["commit"], SEMGREP, FAILED, semgrep_results, record=row)
+            continue
+        if type(semgrep_results) != str:
+            # only matches on or near the lines the fix changed are stored.
+            semgrep_results = classify_results(semgrep_results, prepared["hunks"], hunk_context, keep_unrelated)
+        ledger.mark(row["repository"], row["commit"], SEMGREP, DONE, record=row)
+        rows.append(row)
+        findings.append(make_finding(row, prepared["diff_text"], semgrep_results, current_ruleset_hash))
+        if len(findings) >= db_batch_size:
+            persist(rows, findings, ledger)
+            rows = []
+            findings = []
+            duplicates[:] = link_duplicates(duplicates, ledger)
+    persist(rows, findings, ledger)
+    duplicates[:] = link_duplicates(duplicates, ledger)
+    settle_unlinked_duplicates(duplicates, representatives, ledger)
+    logger.info(f"Ledger: {ledger.summary()}")
 
 def main() -> None:
     args = parse_args()
-    # transform json dump into table
-    table = pd.read_json(args.input, orient="split")
-    analyze_repos(table, args.diffs_only)
+    set_metrics_file(args.metrics)
+    ledger = Ledger(args.ledger)
+    if args.input is not None:
+        records = read_records(args.input)
+    elif args.retry_failed:
+        records = ledger.failed_records()
+    else:
+        raise SystemExit("automate_diffs.py needs --input, or --retry-failed to re-run the ledger's failed records.")
+    analyze_repos(
+        records,
+        args.diffs_only,
+        mirror_cache_from_args(args),
+        SemgrepCache(args.semgrep_cache),
+        ledger,
+        args.jobs,
+        args.batch_size,
+        int(args.batch_max_mb * 1024 ** 2),
+        args.hunk_context,
+        args.keep_unrelated,
+        args.db_batch_size,
+        args.retry_failed,
+        limits_from_args(args),
+        ruleset_from_args(args),
+    )
 
 if __name__ == "__main__":
     main()
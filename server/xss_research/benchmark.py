@@ -0,0 +1,465 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from metrics import format_summary, percentile, read_events, summarize
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+RULESET_FILE = os.path.join(SCRIPT_DIRECTORY, "..", "semgrep.yaml")
+BENCHMARK_DIRECTORY = "benchmark"
+# written into every output directory, so only directories the benchmark made are emptied.
+MARKER_FILE = ".xss-benchmark"
+OWNER = "bench"
+DEFAULT_LANGUAGES = "python:3,javascript:2,ruby:1,go:1,java:1"
+# commits are dated from here, one minute apart, so the same seed gives the same hashes.
+EPOCH = 1600000000
+
+# (extension, filler, vulnerable, fixed) per language; the vulnerable version
+# matches a rule of server/semgrep.yaml and the fixed one doesn't.
+LANGUAGES = {
+    "python": (
+        ".py",
+        "def helper_{n}(value):\n    return str(value).strip()\n",
+        "from django.utils.safestring import mark_safe\n\ndef render_{n}(value):\n    return mark_safe(value)\n",
+        "from django.utils.html import escape\n\ndef render_{n}(value):\n    return escape(value)\n",
+    ),
+    "javascript": (
+        ".js",
+        "function helper{n}(value) {{\n  return String(value).trim();\n}}\n",
+        "app.get('/page{n}', function (req, res) {{\n  res.send(req.query.name);\n}});\n",
+        "app.get('/page{n}', function (req, res) {{\n  res.render('page', {{ name: req.query.name }});\n}});\n",
+    ),
+    "ruby": (
+        ".rb",
+        "def helper_{n}(value)\n  value.to_s.strip\nend\n",
+        "def show_{n}(name)\n  name.html_safe\nend\n",
+        "def show_{n}(name)\n  ERB::Util.html_escape(name)\nend\n",
+    ),
+    "go": (
+        ".go",
+        "func helper{n}(value string) string {{\n\treturn strings.TrimSpace(value)\n}}\n",
+        "package page{n}\n\nimport \"text/template\"\n\nvar page = template.New(\"page{n}\")\n",
+        "package page{n}\n\nimport \"html/template\"\n\nvar page = template.New(\"page{n}\")\n",
+    ),
+    "java": (
+        ".java",
+        "    static String helper{n}(String value) {{\n        return value.trim();\n    }}\n",
+        "import javax.servlet.http.HttpServletResponse;\n\npublic class Page{n} {{\n    public void show(String name, HttpServletResponse resp) throws Exception {{\n        resp.getWriter().write(name);\n    }}\n}}\n",
+        "import javax.servlet.http.HttpServletResponse;\n\npublic class Page{n} {{\n    public void show(String name, HttpServletResponse resp) throws Exception {{\n        resp.getWriter().write(\"ok\");\n    }}\n}}\n",
+    ),
+}
+
+ROUTES = [
+    "/",
+    "/?sort=repo&order=asc",
+    "/?triage_status=unreviewed",
+    "/details/{id}",
+    "/details/{id}/files",
+    "/details/{id}/files/0",
+    "/search?q=mark_safe",
+]
+
+def parse_languages(spec: str) -> List[Tuple[str, int]]:
+    languages = []
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        if name not in LANGUAGES:
+            raise SystemExit(f"Unknown language '{name}', expected one of {', '.join(LANGUAGES)}.")
+        languages.append((name, int(weight or 1)))
+    return languages
+
+def filler_file(language: str, n: int, lines: int) -> str:
+    extension, filler, _, _ = LANGUAGES[language]
+    # about `lines` lines of harmless code.
+    functions = [filler.format(n=n * 1000 + i) for i in range(max(1, lines // filler.count("\n")))]
+    if language == "java":
+        return f"public class Helper{n} {{\n" + "".join(functions) + "}\n"
+    if language == "go":
+        return f"package helper{n}\n\nimport \"strings\"\n\n" + "".join(functions)
+    return "".join(functions)
+
+class FastImport:
+    """Writes a `git fast-import` stream, one commit at a time."""
+
+    def __init__(self):
+        self.chunks = []
+        self.mark = 0
+
+    def data(self, content: bytes):
+        self.chunks.append(b"data %d\n" % len(content) + content + b"\n")
+
+    def commit(self, message: str, files: Dict[str, str]) -> int:
+        self.mark += 1
+        when = EPOCH + self.mark * 60
+        self.chunks.append(b"commit refs/heads/main\nmark :%d\n" % self.mark)
+        self.chunks.append(b"author Bench <bench@example.com> %d +0000\n" % when)
+        self.chunks.append(b"committer Bench <bench@example.com> %d +0000\n" % when)
+        self.data(message.encode('utf-8'))
+        if self.mark > 1:
+            self.chunks.append(b"from :%d\n" % (self.mark - 1))
+        for path, content in sorted(files.items()):
+            self.chunks.append(b"M 100644 inline " + path.encode('utf-8') + b"\n")
+            self.data(content.encode('utf-8'))
+        return self.mark
+
+    def stream(self) -> bytes:
+        return b"".join(self.chunks)
+
+def generate_repo(remote_path: str, raw_path: str, rng: random.Random, languages: List[Tuple[str, int]],
+                  commits: int, files: int, lines: int, fixes: int) -> int:
+    """
+    Creates a bare repository of `commits` commits over `files` files and
+    plants `fixes` commits that replace a vulnerable file with its fixed
+    version. Each fix gets the raw commit JSON get_parents.py reads.
+    """
+    names = [name for name, _ in languages]
+    weights = [weight for _, weight in languages]
+    tree = {}
+    for n in range(files):
+        language = rng.choices(names, weights)[0]
+        tree[f"src/{language}/helper_{n}{LANGUAGES[language][0]}"] = filler_file(language, n, lines)
+
+    stream = FastImport()
+    stream.commit("initial commit", dict(tree))
+    # each vulnerability is introduced by one commit and fixed by the next.
+    total = max(commits, 2 * fixes + 1)
+    introduced_at = set(rng.sample(range(1, total - 1, 2), fixes))
+    fix_marks = []
+    pending = None
+    for i in range(1, total):
+        if pending is not None:
+            path, content, message = pending
+            fix_marks.append((stream.commit(message, {path: content}), message))
+            pending = None
+        elif i in introduced_at:
+            language = rng.choices(names, weights)[0]
+            extension, _, vulnerable, fixed = LANGUAGES[language]
+            path = f"src/{language}/page_{i}{extension}"
+            stream.commit(f"add page {i}", {path: vulnerable.format(n=i)})
+            pending = (path, fixed.format(n=i), f"fix xss in page {i}")
+        else:
+            # an ordinary change to a few files.
+            changed = {}
+            for path in rng.sample(sorted(tree), min(len(tree), rng.randint(1, 3))):
+                tree[path] = tree[path] + "\n"
+                changed[path] = tree[path]
+            stream.commit(f"change {i}", changed)
+
+    os.makedirs(os.path.dirname(remote_path), exist_ok=True)
+    subprocess.run(["git", "init", "--bare", "--quiet", remote_path], check=True)
+    marks_file = os.path.join(remote_path, "bench-marks")
+    subprocess.run(["git", "fast-import", "--quiet", f"--export-marks={marks_file}"], cwd=remote_path,
+                   input=stream.stream(), check=True)
+    subprocess.run(["git", "symbolic-ref", "HEAD", "refs/heads/main"], cwd=remote_path, check=True)
+    with open(marks_file, 'r') as fin:
+        shas = dict(line.split() for line in fin)
+    os.unlink(marks_file)
+
+    os.makedirs(raw_path, exist_ok=True)
+    for mark, message in fix_marks:
+        sha = shas[f":{mark}"]
+        with open(os.path.join(raw_path, sha + ".json"), 'w') as fout:
+            json.dump({"sha": sha, "commit": {"message": message}}, fout)
+    return len(fix_marks)
+
+def generate_corpus(root: str, repos: int, commits: int, files: int, lines: int, fixes: int,
+                    languages: List[Tuple[str, int]], seed: int) -> int:
+    rng = random.Random(seed)
+    planted = 0
+    for i in range(repos):
+        name = f"repo-{i:04d}"
+        planted += generate_repo(
+            os.path.join(root, "remotes", OWNER, name + ".git"),
+            os.path.join(root, "raw", OWNER, name),
+            rng, languages, commits, files, lines, fixes,
+        )
+    return planted
+
+def run_measured(cmd: list, cwd: str, env: dict) -> Tuple[float, int]:
+    """Runs a pipeline stage; returns its wall time and the peak RSS (KB) of its largest process."""
+    start = time.monotonic()
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 reports the largest of the process and the children it waited on, i.e. semgrep too.
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        raise SystemExit(f"'{' '.join(cmd[:2])}' exited with {p.returncode}")
+    return time.monotonic() - start, usage.ru_maxrss
+
+def run_pipeline(root: str, jobs: int, diffs_only: bool) -> dict:
+    env = dict(os.environ, RULE_STATS_DB=os.path.join(root, "bench.db"),
+               SEMGREP_SEND_METRICS="off", SEMGREP_ENABLE_VERSION_CHECK="0")
+    mirrors = [
+        "--remote-base", "file://" + os.path.join(root, "remotes"),
+        "--mirror-directory", os.path.join(root, "mirrors"),
+        "--metrics", os.path.join(root, "metrics.ndjson"),
+    ]
+    shared = mirrors + ["--ledger", os.path.join(root, "ledger.db")]
+    records = os.path.join(root, "records.ndjson")
+    deduplicated = os.path.join(root, "deduplicated.ndjson")
+    stages = {}
+    # the same stages as get_parents_and_diffs.sh, one after the other.
+    stages["get_parents"] = run_measured(
+        [sys.executable, os.path.join(SCRIPT_DIRECTORY, "get_parents.py"), "-d", os.path.join(root, "raw"), "-o", records] + shared,
+        root, env)
+    stages["dedup"] = run_measured(
+        [sys.executable, os.path.join(SCRIPT_DIRECTORY, "dedup.py"), "-i", records, "-o", deduplicated] + mirrors,
+        root, env)
+    automate = [sys.executable, os.path.join(SCRIPT_DIRECTORY, "automate_diffs.py"), "-i", deduplicated, "-j", str(jobs),
+                "--semgrep-cache", os.path.join(root, "semgrep_cache.db"), "--ruleset", os.path.abspath(RULESET_FILE),
+                "--ruleset-directory", os.path.join(root, "rulesets")] + shared
+    if diffs_only:
+        automate.append("--diffs-only")
+    stages["automate_diffs"] = run_measured(automate, root, env)
+    return stages
+
+def prepare_output(root: str):
+    """Empties `root` for a new run, refusing unless it's empty or an earlier run's output."""
+    if os.path.exists(root):
+        if not os.path.isdir(root):
+            raise SystemExit(f"'{root}' exists and isn't a directory.")
+        if os.listdir(root) and not os.path.exists(os.path.join(root, MARKER_FILE)):
+            raise SystemExit(f"'{root}' isn't empty and wasn't written by the benchmark; pass another --output.")
+        shutil.rmtree(root)
+    os.makedirs(root)
+    open(os.path.join(root, MARKER_FILE), 'w').close()
+
+def database_stats(db_path: str) -> dict:
+    connection = sqlite3.connect(db_path)
+    try:
+        findings, = connection.execute("SELECT COUNT(*) FROM finding").fetchone()
+        matches, = connection.execute("SELECT COUNT(*) FROM semgrep_match").fetchone()
+    finally:
+        connection.close()
+    size = sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+    return {"findings": findings, "matches": matches, "bytes": size}
+
+def load_routes(db_path: str, requests: int, threads: int) -> dict:
+    """Requests the index, details and search pages from `threads` threads at once; latencies per route."""
+    os.environ["RULE_STATS_DB"] = db_path
+    from app import app, db
+    from models import Finding
+
+    with app.app_context():
+        ids = [id for id, in db.session.query(Finding.id).order_by(Finding.id)]
+    if not ids:
+        return {}
+    rng = random.Random(0)
+    urls = []
+    for i in range(requests):
+        route = ROUTES[i % len(ROUTES)]
+        urls.append((route, route.format(id=rng.choice(ids))))
+
+    latencies = {}
+    lock = threading.Lock()
+
+    def get(item):
+        route, url = item
+        client = app.test_client()
+        start = time.monotonic()
+        response = client.get(url)
+        elapsed = time.monotonic() - start
+        if response.status_code != 200:
+            logger.info(f"'{url}' returned {response.status_code}")
+        with lock:
+            latencies.setdefault(route, []).append(elapsed)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(get, urls))
+    wall = time.monotonic() - start
+
+    routes = {}
+    for route, values in latencies.items():
+        values.sort()
+        routes[route] = {"requests": len(values), "p50": percentile(values, 50), "p90": percentile(values, 90),
+                         "p99": percentile(values, 99), "max": values[-1]}
+    return {"requests_per_second": len(urls) / wall, "routes": routes}
+
+def format_report(report: dict) -> str:
+    lines = [f"corpus: {report['repos']} repositories, {report['planted']} planted fixes"]
+    for stage, (wall, rss) in report["stages"].items():
+        lines.append(f"{stage:<16} {wall:8.1f} s  peak RSS {rss / 1024:8.1f} MB")
+    db = report["database"]
+    lines.append(f"findings: {db['findings']} ({db['matches']} matches), {report['findings_per_second']:.2f} findings/s")
+    lines.append(f"database: {db['bytes'] / 1024 ** 2:.1f} MB")
+    if report.get("load"):
+        lines.append(f"\nroutes: {report['load']['requests_per_second']:.1f} requests/s")
+        for route, stats in report["load"]["routes"].items():
+            lines.append(f"{route:<28} {stats['requests']:>5}  p50 {stats['p50'] * 1000:7.1f} ms  p90 {stats['p90'] * 1000:7.1f} ms  p99 {stats['p99'] * 1000:7.1f} ms")
+    return "\n".join(lines)
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Benchmarks the pipeline offline: generates a corpus of local git
+            repositories with planted XSS fixes, runs get_parents.py, dedup.py
+            and automate_diffs.py against it through file:// remotes, and loads
+            the triage app's pages. Reports findings per second, peak memory,
+            database size and page latencies.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        required=False,
+        default=BENCHMARK_DIRECTORY,
+        help="Directory the corpus, mirrors and database are written to. It is emptied first if an earlier run wrote it;\nany other non-empty directory is refused."
+    )
+
+    args.add_argument(
+        "--repos",
+        action="store",
+        type=int,
+        required=False,
+        default=10,
+        help="Number of repositories to generate."
+    )
+
+    args.add_argument(
+        "--commits",
+        action="store",
+        type=int,
+        required=False,
+        default=50,
+        help="History depth of each repository."
+    )
+
+    args.add_argument(
+        "--files",
+        action="store",
+        type=int,
+        required=False,
+        default=20,
+        help="Number of files in each repository."
+    )
+
+    args.add_argument(
+        "--file-lines",
+        action="store",
+        type=int,
+        required=False,
+        default=40,
+        help="Approximate number of lines per file."
+    )
+
+    args.add_argument(
+        "--fixes",
+        action="store",
+        type=int,
+        required=False,
+        default=3,
+        help="Number of XSS fix commits planted in each repository."
+    )
+
+    args.add_argument(
+        "--languages",
+        action="store",
+        required=False,
+        default=DEFAULT_LANGUAGES,
+        help=f"Language mix as name:weight pairs, from {', '.join(LANGUAGES)}."
+    )
+
+    args.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        required=False,
+        default=0,
+        help="Seed for the corpus; the same seed generates the same commits."
+    )
+
+    args.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Passed on to automate_diffs.py."
+    )
+
+    args.add_argument(
+        "--diffs-only",
+        action="store_true",
+        required=False,
+        help="Passed on to automate_diffs.py."
+    )
+
+    args.add_argument(
+        "--route-requests",
+        action="store",
+        type=int,
+        required=False,
+        default=700,
+        help="Number of page requests made against the resulting database; 0 to skip."
+    )
+
+    args.add_argument(
+        "--route-threads",
+        action="store",
+        type=int,
+        required=False,
+        default=8,
+        help="Number of concurrent page requests."
+    )
+
+    args.add_argument(
+        "--json",
+        action="store",
+        required=False,
+        help="Also write the report as JSON to this file."
+    )
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    root = os.path.abspath(args.output)
+    prepare_output(root)
+
+    logger.info(f"Generating {args.repos} repositories in '{root}'")
+    planted = generate_corpus(root, args.repos, args.commits, args.files, args.file_lines, args.fixes,
+                              parse_languages(args.languages), args.seed)
+    logger.info("Running the pipeline")
+    stages = run_pipeline(root, args.jobs, args.diffs_only)
+    database = database_stats(os.path.join(root, "bench.db"))
+    report = {
+        "repos": args.repos,
+        "planted": planted,
+        "stages": stages,
+        "database": database,
+        "findings_per_second": database["findings"] / sum(wall for wall, _ in stages.values()),
+    }
+    if args.route_requests > 0:
+        logger.info(f"Requesting {args.route_requests} pages")
+        report["load"] = load_routes(os.path.join(root, "bench.db"), args.route_requests, args.route_threads)
+
+    print(format_report(report))
+    print()
+    print(format_summary(summarize(read_events(os.path.join(root, "metrics.ndjson")))))
+    if args.json:
+        with open(args.json, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import logging
+import os
+import sys
+
+from collections import Counter
+from typing import Dict, List, Optional, Union
+from limits import run_git
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+# the languages the XSS rules cover, by file suffix.
+SUPPORTED_LANGUAGES = {
+    ".go": "go",
+    ".java": "java",
+    ".jsp": "java",
+    ".js": "javascript",
+    ".jsx": "javascript",
+    ".ts": "typescript",
+    ".tsx": "typescript",
+    ".json": "json",
+    ".py": "python",
+    ".rb": "ruby",
+    ".erb": "ruby",
+    ".html": "html",
+    ".yml": "yaml",
+}
+UNSUPPORTED = "unsupported"
+# lockfiles and the like change by hundreds of lines with any dependency bump,
+# so they count neither way.
+GENERATED = "generated"
+GENERATED_NAMES = {
+    "Cargo.lock",
+    "Gemfile.lock",
+    "Pipfile.lock",
+    "composer.lock",
+    "go.sum",
+    "package-lock.json",
+    "pnpm-lock.yaml",
+    "poetry.lock",
+    "yarn.lock",
+}
+# skip a commit if more than this fraction of the lines it changed is in
+# languages we don't support.
+MAX_UNSUPPORTED_FRACTION = 0.2
+
+def language_of(path: str) -> str:
+    name = os.path.basename(path)
+    if name in GENERATED_NAMES or name.endswith(".min.js"):
+        return GENERATED
+    return SUPPORTED_LANGUAGES.get(os.path.splitext(name)[1], UNSUPPORTED)
+
+class ChangedFile:
+    def __init__(self, path: str, old_path: str, added: Optional[int], deleted: Optional[int]):
+        self.path = path
+        # differs from path for renames and copies.
+        self.old_path = old_path
+        # None for binary files.
+        self.added = added
+        self.deleted = deleted
+
+    @property
+    def lines(self) -> int:
+        # every file weighs at least a line, so binary and mode-only changes still count.
+        return max(1, (self.added or 0) + (self.deleted or 0))
+
+class ChangeSummary:
+    """
+    What a fix changed, from a single `git diff --numstat -z`: every changed
+    file with its old path and the lines added and deleted. It decides
+    whether the commit is worth analyzing, weighting each file by the lines
+    it changed and leaving out lockfiles, so neither decides over a one-line
+    template fix, and lists the files to scan, before anything is checked out.
+    """
+
+    def __init__(self, files: List[ChangedFile]):
+        self.files = files
+
+    @classmethod
+    def from_numstat(cls, output: bytes) -> "ChangeSummary":
+        # "added\tdeleted\tpath\0", or "added\tdeleted\t\0old path\0new path\0" for
+        # renames and copies; binary files have "-" counts.
+        files = []
+        fields = output.split(b"\0")
+        i = 0
+        while i < len(fields) and fields[i]:
+            added, deleted, path = fields[i].split(b"\t", 2)
+            i += 1
+            if path:
+                old_path = path
+            else:
+                old_path, path = fields[i], fields[i + 1]
+                i += 2
+            files.append(ChangedFile(
+                path.decode('utf-8', 'surrogateescape'),
+                old_path.decode('utf-8', 'surrogateescape'),
+                None if added == b"-" else int(added),
+                None if deleted == b"-" else int(deleted),
+            ))
+        return cls(files)
+
+    @property
+    def lines(self) -> int:
+        return sum(file.lines for file in self.files)
+
+    def lines_by_language(self) -> Dict[str, int]:
+        lines = Counter()
+        for file in self.files:
+            lines[language_of(file.path)] += file.lines
+        return dict(lines)
+
+    def unsupported_fraction(self) -> float:
+        lines = self.lines_by_language()
+        lines.pop(GENERATED, None)
+        if not lines:
+            return 0.0
+        return lines.get(UNSUPPORTED, 0) / sum(lines.values())
+
+    def supported(self) -> bool:
+        return self.unsupported_fraction() <= MAX_UNSUPPORTED_FRACTION
+
+    def old_paths(self) -> List[str]:
+        return [file.old_path for file in self.files]
+
+def get_change_summary(path: str, old_commit: str, new_commit: str) -> Union[ChangeSummary, str]:
+    p = run_git(["diff", "--numstat", "-z", "--no-color", "--no-ext-diff", old_commit, new_commit], path)
+    if type(p) == str:
+        return p
+    if p.returncode != 0:
+        return "git diff --numstat returned an error."
+    return ChangeSummary.from_numstat(p.stdout)
@@ -0,0 +1,113 @@
+import argparse
+import logging
+import os
+import sys
+
+from typing import Iterator, Optional
+from gitobjects import repository
+from limits import add_limit_args, limits_from_args, run_git, set_limits
+from metrics import add_metrics_args, set_metrics_file, timed
+from mirrors import MirrorCache, add_mirror_args, mirror_cache_from_args
+from records import open_output, read_records, write_record
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+def patch_id(path: str, parent: str, commit: str) -> Optional[str]:
+    """The stable patch id of the change from `parent` to `commit`: the same for a cherry-pick of it anywhere."""
+    p = run_git(["diff", "--no-color", "--no-ext-diff", "--full-index", parent, commit], path)
+    if type(p) == str or p.returncode != 0 or not p.stdout:
+        return None
+    p = run_git(["patch-id", "--stable"], path, input=p.stdout)
+    if type(p) == str or p.returncode != 0 or not p.stdout:
+        return None
+    return p.stdout.split()[0].decode('utf-8')
+
+def tree_pair_id(path: str, parent: str, commit: str) -> Optional[str]:
+    # changes without a textual diff (e.g. only a mode or a binary file) still
+    # have a pair of trees, which forks and mirrors share.
+    old = repository(path).commit(parent)
+    new = repository(path).commit(commit)
+    if old is None or new is None:
+        return None
+    return f"trees:{old['tree']}:{new['tree']}"
+
+def change_id(path: str, parent: str, commit: str) -> Optional[str]:
+    return patch_id(path, parent, commit) or tree_pair_id(path, parent, commit)
+
+def annotate_records(records, mirrors: MirrorCache) -> Iterator[dict]:
+    """
+    Adds the "patch_id" of each record's change against its first parent, so
+    automate_diffs.py analyzes equivalent fixes (the same commit in forks and
+    mirrors, or cherry-picks of it on other branches) once and links the rest
+    to that finding. Records are passed on as they come.
+    """
+    # forks share commits, so most duplicates are found without running git.
+    known = {}
+    total = 0
+    for record in records:
+        total += 1
+        key = (record["parent"][0], record["commit"])
+        if key not in known:
+            path = mirrors.path_for(record["repository"])
+            if not os.path.exists(path):
+                logger.info(f"No mirror of '{record['repository']}'; passing commit '{record['commit']}' on without a patch id")
+                yield record
+                continue
+            with timed("patch-id", record["repository"]):
+                known[key] = change_id(path, record["parent"][0], record["commit"])
+        if known[key] is not None:
+            record["patch_id"] = known[key]
+        yield record
+    distinct = len({id for id in known.values() if id is not None})
+    logger.info(f"{total} record(s), {distinct} distinct change(s)")
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Reads the records written by get_parents.py and writes them again
+            with the patch id of each commit, so automate_diffs.py clones,
+            scans and stores each distinct fix once.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "-i",
+        "--input",
+        action="store",
+        required=False,
+        default="-",
+        help="The records written by get_parents.py. Use '-' for stdin."
+    )
+
+    args.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        required=False,
+        default="-",
+        help="Where to write the records for automate_diffs.py. Use '-' for stdout."
+    )
+
+    add_mirror_args(args)
+    add_limit_args(args)
+    add_metrics_args(args)
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    set_limits(limits_from_args(args))
+    set_metrics_file(args.metrics)
+    fout = open_output(args.output)
+    for record in annotate_records(read_records(args.input), mirror_cache_from_args(args)):
+        write_record(fout, record)
+    if fout is not sys.stdout:
+        fout.close()
+
+if __name__ == "__main__":
+    main()
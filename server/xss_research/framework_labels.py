@@ -0,0 +1,114 @@
+import argparse
+import logging
+import math
+import os
+import sys
+import pandas as pd
+
+from typing import Dict, Tuple
+from app import app
+from analysis import FRAMEWORK_LABEL_FILES, LABELS_DIRECTORY, ROUND2_UPDATES_FILE
+from database import db
+from models import FrameworkLabel
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+# (file, overrides) from the highest precedence down: the round 2 updates
+# replace everything, then the labels in the order the notebook concatenates
+# them.
+LABEL_SOURCES = [(ROUND2_UPDATES_FILE, True)] + [(name, False) for name in FRAMEWORK_LABEL_FILES]
+LABEL_FIELDS = ["position", "framework", "triage_status", "note"]
+
+def value(cell):
+    if cell is None or (isinstance(cell, float) and math.isnan(cell)):
+        return None
+    return str(cell).strip() or None
+
+def read_labels(path: str, overrides: bool) -> Dict[Tuple[str, str], dict]:
+    """The labels of one file by (repo_url, fix_commit)."""
+    labels = pd.read_csv(path, dtype=str)
+    wanted = {}
+    for position, row in enumerate(labels.to_dict("records")):
+        key = (value(row.get("repo_url")), value(row.get("fix_commit")))
+        if None in key:
+            continue
+        # a commit labeled twice keeps its first label, unless the file
+        # overrides, where the updates apply in order and the last one wins.
+        if key in wanted and not overrides:
+            continue
+        wanted[key] = {
+            "position": position,
+            "framework": value(row.get("framework")),
+            "triage_status": value(row.get("triage_status")) if overrides else None,
+            "note": value(row.get("note")),
+        }
+    return wanted
+
+def import_source(path: str, source: str, precedence: int, overrides: bool) -> Tuple[int, int, int]:
+    """Brings the rows of `source` in line with its file; returns how many were added, changed and removed."""
+    wanted = read_labels(path, overrides)
+    existing = {(label.repo_url, label.fix_commit): label for label in FrameworkLabel.query.filter(FrameworkLabel.source == source)}
+    added = changed = 0
+    for key, fields in wanted.items():
+        label = existing.pop(key, None)
+        if label is None:
+            db.session.add(FrameworkLabel(repo_url=key[0], fix_commit=key[1], source=source,
+                precedence=precedence, overrides=overrides, **fields))
+            added += 1
+            continue
+        if label.precedence == precedence and label.overrides == overrides and all(getattr(label, name) == fields[name] for name in LABEL_FIELDS):
+            continue
+        label.precedence = precedence
+        label.overrides = overrides
+        for name in LABEL_FIELDS:
+            setattr(label, name, fields[name])
+        changed += 1
+    for label in existing.values():
+        db.session.delete(label)
+    return added, changed, len(existing)
+
+def import_labels(labels_directory: str = LABELS_DIRECTORY) -> Dict[str, Tuple[int, int, int]]:
+    counts = {}
+    with app.app_context():
+        for precedence, (source, overrides) in enumerate(LABEL_SOURCES):
+            counts[source] = import_source(os.path.join(labels_directory, source), source, precedence, overrides)
+        # labels of files that are no longer imported would keep their precedence forever.
+        sources = [source for source, _ in LABEL_SOURCES]
+        removed = FrameworkLabel.query.filter(FrameworkLabel.source.notin_(sources)).delete(synchronize_session=False)
+        if removed:
+            counts["(other files)"] = (0, 0, removed)
+        db.session.commit()
+    return counts
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Imports the framework label CSVs into the framework_label table,
+            where the triage UI filters by framework and analysis.py joins
+            them to the findings. Re-running it only touches the labels that
+            changed.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "--labels-directory",
+        action="store",
+        required=False,
+        default=LABELS_DIRECTORY,
+        help="Directory with the framework label CSVs."
+    )
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    for source, (added, changed, removed) in import_labels(args.labels_directory).items():
+        logger.info(f"{source}: {added} added, {changed} changed, {removed} removed")
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,16 @@ import argparse
 import os
 import logging
 import json
-import subprocess
 import sys
-import pandas as pd
 from app import app
-from util import cwd
 from models import Finding, TriageStatus
 from database import db
+from gitobjects import repository
+from mirrors import MirrorCache, add_mirror_args, directory_size, mirror_cache_from_args
+from limits import add_limit_args, limits_from_args, set_limits
+from metrics import add_metrics_args, set_metrics_file, timed
+from records import open_output, write_record
+from ledger import DOWNLOAD, DONE, FAILED, PARENTS, SKIPPED, Ledger, add_ledger_args, is_selected
 
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.DEBUG)
@@ -16,8 +19,6 @@ handler = logging.StreamHandler(stream=sys.stderr)
 handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger.addHandler(handler)
 
-DOWNLOADED_REPO_DIRECTORY = "downloaded_repos"
-
 def parse_args():
     parser = argparse.ArgumentParser(
         description="""
@@ -43,36 +44,69 @@ def parse_args():
         required=False,
         help="This flag makes it so that you don't download the repositories and instead analyze based off of what you have."
     )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        required=False,
+        default="github_data.ndjson",
+        help="Where to write one JSON record per line for automate_diffs.py. Use '-' for stdout."
+    )
+
+    parser.add_argument(
+        "--max-repo-size-mb",
+        action="store",
+        type=float,
+        required=False,
+        default=None,
+        help="Skip repositories whose mirror is larger than this; they're recorded as skipped in the ledger."
+    )
+
+    add_mirror_args(parser)
+    add_ledger_args(parser)
+    add_limit_args(parser)
+    add_metrics_args(parser)
     
     return parser.parse_args()
 
-def download_repo(repo_name: str):
-    if "webkit" in repo_name.lower():
-        logger.info(f"Repo '{repo_name}' is a webkit")
-        return -1
-    git_url = "https://github.com/" + repo_name + ".git"
-    logger.info(f"Downloading repo '{git_url}'")
-    with cwd(DOWNLOADED_REPO_DIRECTORY):
-        try:
-            subprocess.run(["git", "clone", git_url, repo_name], capture_output=True, timeout=60)
-        except subprocess.TimeoutExpired:
-            logger.info(f"Repo {repo_name} download took too long")
-            return -1
-    return 1
-
-def get_parent_commit(commit: str, repo_name: str) -> str:
-    logger.info(f"Getting the parent commit for '{commit}'")
-    path_to_repo = DOWNLOADED_REPO_DIRECTORY + '/' + repo_name
+def download_repo(mirrors: MirrorCache, repo_name: str, commits: list):
+    if mirrors.ensure(repo_name, commits) is None:
+        logger.info(f"Repo {repo_name} could not be downloaded")
+        return "Repository could not be downloaded."
+    return None
+
+def repo_too_large(mirrors: MirrorCache, repo_name: str, max_repo_size_mb: float):
+    size_mb = directory_size(mirrors.path_for(repo_name)) / 1024 ** 2
+    if size_mb > max_repo_size_mb:
+        logger.info(f"Repo '{repo_name}' is {size_mb:.0f} MB")
+        return f"Repository is larger than {max_repo_size_mb:g} MB."
+    return None
+
+def count_changed_files(path_to_repo: str, parent: str, commit: str):
+    # compares trees only, so it works on a blobless mirror without fetching anything.
+    changed = repository(path_to_repo).changed_paths(parent, commit)
+    if changed is None:
+        return None
+    return len(changed)
+
+def get_parent_commits(mirrors: MirrorCache, repo_name: str, commits: list) -> dict:
+    # resolves every commit of a repository through its shared `git cat-file --batch` process.
+    path_to_repo = mirrors.path_for(repo_name)
     if not os.path.exists(path_to_repo):
         logger.info(f"Path {path_to_repo} doesn't exist.")
-        return "Parent commit retriever returned error."
-    with cwd(path_to_repo):
-        p = subprocess.run(["git", "log", "--pretty=%P", "-n", "1", commit], capture_output=True)
-        if p.returncode != 0:
-            return "Parent commit retriever returned error."
-
-        parent_commit = p.stdout.decode('utf-8')
-        return parent_commit.strip('\n')
+        return {}
+    logger.info(f"Getting the parent commits of {len(commits)} commit(s) in '{repo_name}'")
+    resolved = {}
+    cat_file = repository(path_to_repo)
+    with timed("rev-parse", repo_name, commits=len(commits)):
+        for commit in commits:
+            obj = cat_file.commit(commit)
+            if obj is None:
+                logger.info(f"Commit '{commit}' does not exist in '{repo_name}'")
+                continue
+            resolved[commit] = obj
+    return resolved
 
 def get_commit_message(file_name: str) -> str:
     with open(file_name, 'r') as f:
@@ -87,35 +121,91 @@ def get_commit_name(file_name: str) -> str:
     dirs = file_name.split('/')
     return (dirs[-1].replace('.json', ''))
 
+def iter_repos(directory: str):
+    # the commits of a repository all live in one <owner>/<repo> directory, so
+    # walking lazily yields one repository's [(commit, file)] at a time.
+    for dirpath, subdirs, files in os.walk(directory):
+        commit_files = []
+        for file in sorted(files):
+            file = os.path.join(dirpath, file)
+            commit_files.append((get_commit_name(file), file))
+        if commit_files:
+            yield get_repo_name(commit_files[0][1]), commit_files
+
+def iter_records(mirrors: MirrorCache, directory: str, download: bool, ledger: Ledger, retry_failed: bool = False,
+                 max_repo_size_mb: float = None):
+    for repo_name, commit_files in iter_repos(directory):
+        states = ledger.states(repo_name)
+        unresolved = []
+        for commit, file in commit_files:
+            state = states.get(commit)
+            if not is_selected(state, retry_failed):
+                continue
+            if state is not None and state["record"] is not None:
+                # resolved by an earlier run; the repository isn't touched again.
+                yield json.loads(state["record"])
+            else:
+                unresolved.append((commit, file))
+        if not unresolved:
+            continue
+
+        if download:
+            with timed("clone", repo_name) as metrics:
+                path = mirrors.path_for(repo_name)
+                size = directory_size(path) if os.path.exists(path) else 0
+                reason = download_repo(mirrors, repo_name, [commit for commit, file in unresolved])
+                if os.path.exists(path):
+                    metrics["bytes"] = directory_size(path) - size
+            if reason is not None:
+                ledger.mark_many([(repo_name, commit) for commit, file in unresolved], DOWNLOAD, FAILED, reason)
+                continue
+        if max_repo_size_mb is not None and os.path.exists(mirrors.path_for(repo_name)):
+            reason = repo_too_large(mirrors, repo_name, max_repo_size_mb)
+            if reason is not None:
+                ledger.mark_many([(repo_name, commit) for commit, file in unresolved], DOWNLOAD, SKIPPED, reason)
+                continue
+
+        # get the parent commits of the repository.
+        commits = get_parent_commits(mirrors, repo_name, [commit for commit, file in unresolved])
+        for commit, file in unresolved:
+            if not commit in commits:
+                ledger.mark(repo_name, commit, PARENTS, FAILED, "Commit does not exist in the repository.")
+                continue
+            parents = commits[commit]["parents"]
+            if len(parents) == 0:
+                logger.info(f"Skipping '{commit}' in '{repo_name}' because it is a root commit.")
+                ledger.mark(repo_name, commit, PARENTS, SKIPPED, "Root commit.")
+                continue
+            if len(parents) > 1:
+                # automate_diffs.py diffs against the first parent, i.e. the branch the merge landed on.
+                logger.info(f"Commit '{commit}' in '{repo_name}' is a merge of {len(parents)} parents.")
+            record = {
+                "repository": repo_name,
+                "commit": commit,
+                "parent": parents,
+                "message": get_commit_message(file),
+            }
+            # lets automate_diffs.py start the most expensive commits first.
+            with timed("diff-tree", repo_name):
+                changed_files = count_changed_files(mirrors.path_for(repo_name), parents[0], commit)
+            if changed_files is not None:
+                record["changed_files"] = changed_files
+            ledger.mark(repo_name, commit, PARENTS, DONE, record=record)
+            yield record
+
 def main() -> None:
     args = parse_args()
-    list_of_rows = []
-    list_of_files = []
-    # get all file names
-    for dirpath, subdirs, files in os.walk(args.directory):
-        for file in files:
-            file = os.path.join(dirpath, file)
-            list_of_files.append(file)
-
-    # download every repository.
-    if not args.no_download:
-        for file in list_of_files:
-            download_repo(get_repo_name(file))
-
-    # get the parent commit of each repository.
-    for file in list_of_files:
-        parent_commit = get_parent_commit(get_commit_name(file), get_repo_name(file))
-        commit_message = get_commit_message(file)
-        if not parent_commit == "Parent commit retriever returned error.":
-            list_of_rows.append([get_repo_name(file), get_commit_name(file), [parent_commit], commit_message])
-
-    # make a table.
-    df = pd.DataFrame(list_of_rows, columns=["repository", "commit", "parent", "message"])
-    # convert to json.
-    table_to_json = df.to_json(orient="split")
-    parsed = json.loads(table_to_json)
-    with open("github_data.json", 'w') as f:
-        json.dump(parsed, f, indent=4)
+    set_limits(limits_from_args(args))
+    set_metrics_file(args.metrics)
+    mirrors = mirror_cache_from_args(args)
+    # records are written as soon as they're resolved, so automate_diffs.py can read them as they arrive.
+    fout = open_output(args.output)
+    ledger = Ledger(args.ledger)
+    for record in iter_records(mirrors, args.directory, not args.no_download, ledger, args.retry_failed, args.max_repo_size_mb):
+        write_record(fout, record)
+    logger.info(f"Ledger: {ledger.summary()}")
+    if fout is not sys.stdout:
+        fout.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
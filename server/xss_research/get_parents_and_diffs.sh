@@ -1,3 +1,18 @@
 #!/bin/bash
-time python3 get_parents.py 1>get_parents_stdout.out 2>get_parents_stderr.out
-time python3 automate_diffs.py -i github_data.json 1>automate_diffs_stdout.out 2>automate_diffs_stderr.out
+# get_parents.py writes each record as soon as it is resolved and automate_diffs.py
+# reads them as they arrive, so analysis starts on the first repository while the
+# rest are still being mirrored. tee keeps a copy of the records for re-runs.
+# Both scripts record each commit's progress in pipeline_ledger.db, so running
+# this again after a crash only does the work that wasn't finished; pass
+# --retry-failed to both to also retry the commits that failed.
+# Per-stage timings are appended to pipeline_metrics.ndjson; `python3 metrics.py`
+# summarizes them, and the app shows the same summary at /metrics.
+# The XSS ruleset is revalidated against the copy stored in rulesets/; pin a
+# version with `python3 rulesets.py --pin <hash>` (or pass --offline) to run
+# without the network.
+# dedup.py adds each commit's patch id, so the same fix in forks, mirrors and
+# cherry-picks is scanned once and its other findings share the triage.
+time (python3 get_parents.py -o - 2>get_parents_stderr.out \
+    | python3 dedup.py -i - -o - 2>dedup_stderr.out \
+    | tee github_data.ndjson \
+    | python3 automate_diffs.py -i - 1>automate_diffs_stdout.out 2>automate_diffs_stderr.out)
@@ -0,0 +1,233 @@
+import atexit
+import collections
+import logging
+import os
+import subprocess
+import sys
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+# repositories kept open per process by `repository`; each costs two git processes.
+MAX_OPEN_REPOSITORIES = 8
+
+TREE_MODE = b"40000"
+SYMLINK_MODE = b"120000"
+SUBMODULE_MODE = b"160000"
+
+class CatFile:
+    """
+    Reads objects out of a repository through two long-lived git processes,
+    `git cat-file --batch` for contents and `git cat-file --batch-check` for
+    the type and size of an object, instead of one git process per lookup.
+    Commits, parents, trees and file listings are all answered from these,
+    so they work on a blobless mirror without fetching anything.
+    """
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.process = self.start("--batch")
+        self.check_process = None
+
+    def start(self, mode: str) -> subprocess.Popen:
+        # commits and trees are all in a blobless mirror; a missing one is
+        # reported as missing instead of being fetched from the remote.
+        return subprocess.Popen(
+            ["git", "cat-file", mode],
+            cwd=self.repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=dict(os.environ, GIT_NO_LAZY_FETCH="1"),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, process: subprocess.Popen, rev: str) -> Optional[Tuple[str, str, int]]:
+        process.stdin.write(rev.encode('utf-8') + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().decode('utf-8').split()
+        if len(header) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            return None
+        sha, object_type, size = header
+        return sha, object_type, int(size)
+
+    def info(self, rev: str) -> Optional[Tuple[str, str, int]]:
+        """Returns (sha, type, size) for `rev` without reading it, or None if it doesn't name an object."""
+        if self.check_process is None:
+            self.check_process = self.start("--batch-check")
+        return self.request(self.check_process, rev)
+
+    def read(self, rev: str):
+        """Returns (sha, type, content) for `rev`, or None if it doesn't name an object."""
+        header = self.request(self.process, rev)
+        if header is None:
+            return None
+        sha, object_type, size = header
+        content = self.process.stdout.read(size)
+        # every object is followed by a newline.
+        self.process.stdout.read(1)
+        return sha, object_type, content
+
+    def resolve(self, rev: str) -> Optional[str]:
+        """The sha of the commit `rev` names, or None."""
+        info = self.info(f"{rev}^{{commit}}")
+        return info[0] if info is not None else None
+
+    def commit(self, rev: str) -> Optional[dict]:
+        obj = self.read(rev)
+        if obj is None or obj[1] != "commit":
+            return None
+        sha, _, content = obj
+        headers, _, message = content.partition(b"\n\n")
+        commit = {"sha": sha, "tree": None, "parents": [], "message": message.decode('utf-8', 'replace')}
+        for line in headers.split(b"\n"):
+            key, _, value = line.partition(b" ")
+            if key == b"tree":
+                commit["tree"] = value.decode('utf-8')
+            elif key == b"parent":
+                commit["parents"].append(value.decode('utf-8'))
+        return commit
+
+    def parents(self, rev: str) -> Optional[List[str]]:
+        commit = self.commit(rev)
+        return commit["parents"] if commit is not None else None
+
+    def tree(self, rev: str) -> Optional[Dict[str, Tuple[bytes, str]]]:
+        """Maps each entry of a tree (or of a commit's root tree) to its (mode, sha)."""
+        obj = self.read(f"{rev}^{{tree}}")
+        if obj is None:
+            return None
+        content = obj[2]
+        entries = {}
+        i = 0
+        # "<mode> <name>\0<20 byte sha>" per entry.
+        while i < len(content):
+            space = content.index(b" ", i)
+            nul = content.index(b"\0", space)
+            name = content[space + 1:nul].decode('utf-8', 'surrogateescape')
+            entries[name] = (content[i:space], content[nul + 1:nul + 21].hex())
+            i = nul + 21
+        return entries
+
+    def walk(self, tree: str, prefix: str = "") -> Iterable[Tuple[str, bytes, str]]:
+        """Every non-tree entry under `tree`, recursively, as (path, mode, sha)."""
+        entries = self.tree(tree)
+        for name, (mode, sha) in (entries or {}).items():
+            if mode == TREE_MODE:
+                yield from self.walk(sha, prefix + name + "/")
+            else:
+                yield prefix + name, mode, sha
+
+    def files(self, rev: str, paths: Optional[List[str]] = None) -> Optional[Dict[str, str]]:
+        """
+        Maps each regular file of `rev` (or only those of `paths` that exist)
+        to its blob sha, like `git ls-tree -r`. Symlinks and submodules are
+        left out. None if `rev` has no tree.
+        """
+        root = self.tree(rev)
+        if root is None:
+            return None
+        if paths is None:
+            entries = ((path, mode, sha) for path, mode, sha in self.walk(rev))
+        else:
+            entries = (entry for entry in (self.lookup(root, path) for path in paths) if entry is not None)
+        return {path: sha for path, mode, sha in entries if mode not in (TREE_MODE, SYMLINK_MODE, SUBMODULE_MODE)}
+
+    def lookup(self, root: dict, path: str) -> Optional[Tuple[str, bytes, str]]:
+        entries = root
+        parts = path.split("/")
+        for i, name in enumerate(parts):
+            entry = entries.get(name) if entries is not None else None
+            if entry is None:
+                return None
+            mode, sha = entry
+            if i == len(parts) - 1:
+                return path, mode, sha
+            entries = self.tree(sha) if mode == TREE_MODE else None
+
+    def changed_paths(self, old: str, new: str) -> Optional[List[str]]:
+        """The files that differ between two commits, like `git diff-tree -r --name-only`, from their trees alone."""
+        old_tree = self.tree(old)
+        new_tree = self.tree(new)
+        if old_tree is None or new_tree is None:
+            return None
+        changed = []
+        self.compare(old_tree, new_tree, "", changed)
+        return changed
+
+    def compare(self, old: dict, new: dict, prefix: str, changed: list):
+        for name in sorted(set(old) | set(new)):
+            a = old.get(name)
+            b = new.get(name)
+            if a == b:
+                continue
+            a_is_tree = a is not None and a[0] == TREE_MODE
+            b_is_tree = b is not None and b[0] == TREE_MODE
+            if a_is_tree and b_is_tree:
+                # unchanged subtrees have the same sha and are never read.
+                self.compare(self.tree(a[1]), self.tree(b[1]), prefix + name + "/", changed)
+                continue
+            paths = set()
+            for entry, is_tree in ((a, a_is_tree), (b, b_is_tree)):
+                if entry is None:
+                    continue
+                if is_tree:
+                    paths.update(path for path, mode, sha in self.walk(entry[1], prefix + name + "/"))
+                else:
+                    paths.add(prefix + name)
+            changed.extend(sorted(paths))
+
+    def close(self):
+        for process in (self.process, self.check_process):
+            if process is None:
+                continue
+            if process.poll() is None:
+                process.stdin.close()
+                process.wait()
+            process.stdout.close()
+
+_repositories = collections.OrderedDict()
+_pid = None
+
+def repository(repo_path: str) -> CatFile:
+    """
+    The open CatFile of `repo_path`, shared by every stage of this process,
+    so a repository's git processes are started once rather than per lookup.
+    The least recently used ones are closed beyond MAX_OPEN_REPOSITORIES.
+    """
+    global _pid
+    if _pid != os.getpid():
+        # a forked worker can't share its parent's pipes; it opens its own.
+        _repositories.clear()
+        _pid = os.getpid()
+    repo_path = os.path.abspath(repo_path)
+    cat_file = _repositories.pop(repo_path, None)
+    if cat_file is None or cat_file.process.poll() is not None:
+        cat_file = CatFile(repo_path)
+    _repositories[repo_path] = cat_file
+    while len(_repositories) > MAX_OPEN_REPOSITORIES:
+        _, oldest = _repositories.popitem(last=False)
+        oldest.close()
+    return cat_file
+
+def close_repository(repo_path: str):
+    cat_file = _repositories.pop(os.path.abspath(repo_path), None) if _pid == os.getpid() else None
+    if cat_file is not None:
+        cat_file.close()
+
+@atexit.register
+def close_repositories():
+    if _pid == os.getpid():
+        while _repositories:
+            _repositories.popitem()[1].close()
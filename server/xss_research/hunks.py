@@ -0,0 +1,193 @@
+import bisect
+import codecs
+import logging
+import re
+import sys
+
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+IN_HUNK = "in_hunk"
+NEAR_HUNK = "near_hunk"
+UNRELATED = "unrelated"
+DEFAULT_HUNK_CONTEXT = 3
+
+HUNK_HEADER = re.compile(rb"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+def unquote_path(path: bytes) -> str:
+    # git C-quotes paths with unusual characters, e.g. "a/caf\303\251.py"
+    if path.startswith(b'"') and path.endswith(b'"'):
+        path = codecs.escape_decode(path[1:-1])[0]
+    return path.decode('utf-8', 'surrogateescape')
+
+class HunkIndex:
+    """
+    The line ranges of the old commit that a fix changed, per file. The
+    changed blocks of a diff never overlap and come in order, so each file's
+    ranges are kept as two sorted lists and a match is located with a binary
+    search.
+    """
+
+    def __init__(self, hunks: Dict[str, List[Tuple[int, int]]]):
+        self.starts = {}
+        self.ends = {}
+        for path, ranges in hunks.items():
+            ranges = sorted(ranges)
+            self.starts[path] = [start for start, _ in ranges]
+            self.ends[path] = [end for _, end in ranges]
+
+    @classmethod
+    def from_diff(cls, diff: bytes) -> "HunkIndex":
+        """
+        Reads the changed blocks out of a `git diff` with any amount of context,
+        so the diff that is stored serves for the hunks too. Each run of -/+ lines
+        gives the same range as its hunk in a `git diff -U0`.
+        """
+        hunks = {}
+        path = None
+        old_left = new_left = 0
+        # the old line the next line of the hunk is at, and where the current block of changes started.
+        old_line = 0
+        block = None
+        deleted = False
+
+        def close_block():
+            if block is None:
+                return
+            if deleted:
+                hunks.setdefault(path, []).append((block, old_line - 1))
+            else:
+                # lines were only added, after line `block - 1`; both neighbours count.
+                hunks.setdefault(path, []).append((max(block - 1, 1), block))
+
+        for line in diff.split(b"\n"):
+            if old_left or new_left:
+                if line.startswith(b"\\"):
+                    # "\ No newline at end of file"
+                    continue
+                if line.startswith(b"-") or line.startswith(b"+"):
+                    if block is None:
+                        block = old_line
+                        deleted = False
+                    if line.startswith(b"-"):
+                        deleted = True
+                        old_line += 1
+                        old_left -= 1
+                    else:
+                        new_left -= 1
+                else:
+                    # a context line.
+                    close_block()
+                    block = None
+                    old_line += 1
+                    old_left -= 1
+                    new_left -= 1
+                if not (old_left > 0 or new_left > 0):
+                    close_block()
+                    block = None
+                    old_left = new_left = 0
+                continue
+            if line.startswith(b"--- "):
+                name = line[4:]
+                path = None if name == b"/dev/null" else unquote_path(name)
+                if path is not None and path.startswith("a/"):
+                    path = path[2:]
+                continue
+            match = HUNK_HEADER.match(line)
+            if match is None or path is None:
+                continue
+            old_left = int(match.group(2) or 1)
+            new_left = int(match.group(4) or 1)
+            # an empty old side is given as the line before it.
+            old_line = int(match.group(1)) + (1 if old_left == 0 else 0)
+        return cls(hunks)
+
+    def distance(self, path: str, start_line: int, end_line: int) -> Optional[int]:
+        """Lines between a range of the old file and the nearest hunk; 0 if they overlap, None if the file didn't change."""
+        starts = self.starts.get(path)
+        if not starts:
+            return None
+        ends = self.ends[path]
+        i = bisect.bisect_right(starts, end_line)
+        distances = []
+        if i > 0:
+            distances.append(max(0, start_line - ends[i - 1]))
+        if i < len(starts):
+            distances.append(starts[i] - end_line)
+        return min(distances)
+
+    def classify(self, path: str, start_line: int, end_line: int, context: int = DEFAULT_HUNK_CONTEXT) -> str:
+        distance = self.distance(path, start_line, end_line)
+        if distance is None:
+            return UNRELATED
+        if distance == 0:
+            return IN_HUNK
+        if distance <= context:
+            return NEAR_HUNK
+        return UNRELATED
+
+def index_diff_files(diff_text: str) -> List[dict]:
+    """
+    Splits a full `git diff` into one entry per file with its character range
+    in `diff_text`, so a single file's diff can be served without re-parsing.
+    """
+    files = []
+    offset = 0
+    current = None
+    for line in diff_text.split("\n"):
+        if line.startswith("diff --git "):
+            current = {"position": len(files), "start": offset, "length": 0, "old_path": None, "path": None,
+                       "additions": 0, "deletions": 0, "in_hunks": False}
+            # "diff --git a/<path> b/<path>", used when there are no ---/+++ lines
+            # (binary files, mode changes); only right when both paths are equal.
+            names = line[len("diff --git "):]
+            half = (len(names) - 1) // 2
+            current["old_path"] = current["path"] = unquote_path(names[half + 1:].encode('utf-8', 'surrogateescape'))[2:]
+            files.append(current)
+        elif current is not None:
+            if line.startswith("@@"):
+                current["in_hunks"] = True
+            elif current["in_hunks"]:
+                if line.startswith("+"):
+                    current["additions"] += 1
+                elif line.startswith("-"):
+                    current["deletions"] += 1
+            elif line.startswith("--- ") or line.startswith("+++ "):
+                name = unquote_path(line[4:].encode('utf-8', 'surrogateescape'))
+                if name == "/dev/null":
+                    name = None
+                else:
+                    # strip the a/ or b/ prefix.
+                    name = name[2:]
+                current["old_path" if line.startswith("-") else "path"] = name
+            elif line.startswith("rename from "):
+                current["old_path"] = unquote_path(line[len("rename from "):].encode('utf-8', 'surrogateescape'))
+            elif line.startswith("rename to "):
+                current["path"] = unquote_path(line[len("rename to "):].encode('utf-8', 'surrogateescape'))
+        offset += len(line) + 1
+        if current is not None:
+            current["length"] = min(offset, len(diff_text)) - current["start"]
+
+    for file in files:
+        # deleted files are listed under their old path.
+        file["path"] = file["path"] or file["old_path"]
+        del file["in_hunks"]
+    return files
+
+def classify_results(results: List[dict], hunks: Optional[HunkIndex], context: int = DEFAULT_HUNK_CONTEXT,
+                     keep_unrelated: bool = False) -> List[dict]:
+    """Sets each result's "relevance" to the fix and drops the unrelated ones unless `keep_unrelated`."""
+    if hunks is None:
+        # nothing to compare against, so keep everything unclassified.
+        return results
+    classified = []
+    for result in results:
+        result["relevance"] = hunks.classify(result["path"], result["start"]["line"], result["end"]["line"], context)
+        if keep_unrelated or result["relevance"] != UNRELATED:
+            classified.append(result)
+    return classified
@@ -5,8 +5,10 @@ import subprocess
 import sys
 from database import db
 from app import app
-from util import cwd, git_checkout
-from models import Finding, TriageStatus
+from util import WorktreeManager
+from automate_diffs import get_diff_text
+from gitobjects import repository
+from models import DiffFile, Finding, SemgrepMatch, TriageStatus
 
 from typing import Any
 
@@ -19,17 +21,13 @@ logger.addHandler(handler)
 with app.app_context():
     db.create_all()
 
-def get_diff_text(directory: str, previous_commit: str, fix_commit: str) -> str:
-    with cwd(directory):
-        p = subprocess.run(["git", "--no-pager", "diff", f"{previous_commit}..{fix_commit}"], capture_output=True)
-        diff_text = p.stdout
-    return diff_text.decode('utf-8')
-
-def get_semgrep_results(directory: str, commit: str, config: str) -> str:
-    with cwd(directory):
-        with git_checkout(commit):
-            p = subprocess.run(["semgrep", "-f", config], stdout=subprocess.PIPE)
-            results = p.stdout.decode('utf-8')
+def get_semgrep_results(worktrees: WorktreeManager, commit: str, config: str):
+    worktree_path = worktrees.checkout(commit)
+    if worktree_path is None:
+        # without a worktree, semgrep would scan this process' own directory.
+        return "git worktree add returned an error."
+    p = subprocess.run(["semgrep", "--json", "-f", config], cwd=worktree_path, stdout=subprocess.PIPE)
+    results = json.loads(p.stdout.decode('utf-8'))["results"]
     return results
 
 if __name__ == "__main__":
@@ -45,21 +43,32 @@ if __name__ == "__main__":
 
     CONFIG_URL = "p/xss"
 
-    diff_text = get_diff_text(args.directory, args.previous_commit, args.fix_commit)
-    semgrep_results_on_diff = get_semgrep_results(args.directory, args.fix_commit, CONFIG_URL)
-    previous_semgrep_results = get_semgrep_results(args.directory, args.previous_commit, CONFIG_URL)
+    # the commits are stored by hash, however they were named.
+    fix_commit = repository(args.directory).resolve(args.fix_commit)
+    previous_commit = repository(args.directory).resolve(args.previous_commit)
+    if fix_commit is None or previous_commit is None:
+        sys.exit(f"Couldn't resolve '{args.fix_commit}' and '{args.previous_commit}' in '{args.directory}'")
+
+    diff_text = get_diff_text(args.directory, previous_commit, fix_commit)
+    with WorktreeManager(args.directory) as worktrees:
+        semgrep_results_on_diff = get_semgrep_results(worktrees, fix_commit, CONFIG_URL)
+        previous_semgrep_results = get_semgrep_results(worktrees, previous_commit, CONFIG_URL)
+    for commit, results in ((fix_commit, semgrep_results_on_diff), (previous_commit, previous_semgrep_results)):
+        if type(results) == str:
+            sys.exit(f"Couldn't scan commit '{commit}' of '{args.directory}': {results}")
     finding = Finding(
         repo_url = args.directory,
-        fix_commit = args.fix_commit,
-        previous_commit = args.previous_commit,
+        fix_commit = fix_commit,
+        previous_commit = previous_commit,
         diff_text = diff_text,
-        semgrep_results_on_diff = semgrep_results_on_diff,
+        matches = [SemgrepMatch.from_semgrep_result(result) for result in semgrep_results_on_diff],
+        diff_files = DiffFile.from_diff(diff_text),
         triage_status = TriageStatus(0),
         reviewer_notes = "",
     )
     if args.dryrun:
-        print(finding.fix_semgrep_results)
-        print(finding.previous_semgrep_results)
+        print(json.dumps(semgrep_results_on_diff, indent=2))
+        print(json.dumps(previous_semgrep_results, indent=2))
     else:
         with app.app_context():
             db.session.add(finding)
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+LEDGER_FILE = "pipeline_ledger.db"
+
+# the stages a (repository, commit) goes through, in order.
+DOWNLOAD = "download"
+PARENTS = "parents"
+DIFF = "diff"
+SEMGREP = "semgrep"
+PERSIST = "persist"
+STAGES = (DOWNLOAD, PARENTS, DIFF, SEMGREP, PERSIST)
+
+DONE = "done"
+FAILED = "failed"
+# finished without a finding, e.g. a root commit or an unsupported language.
+SKIPPED = "skipped"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    repository TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    record TEXT,
+    failures INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (repository, commit_sha)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS job_status ON job (status, stage);
+"""
+
+class Ledger:
+    """
+    Records how far each (repository, commit) got through the pipeline, so a
+    run that died halfway restarts where it stopped instead of redoing every
+    clone, parent lookup and scan. Only the last stage reached is kept, along
+    with why it failed or was skipped, and the record get_parents.py resolved
+    for it so failed items can be retried without re-resolving them.
+    """
+
+    def __init__(self, path: str = LEDGER_FILE):
+        self.path = os.path.abspath(path)
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, repository: str, commit: str) -> Optional[sqlite3.Row]:
+        return self.connection.execute(
+            "SELECT * FROM job WHERE repository = ? AND commit_sha = ?", (repository, commit)
+        ).fetchone()
+
+    def states(self, repository: str) -> Dict[str, sqlite3.Row]:
+        """Maps each commit of `repository` in the ledger to its state."""
+        rows = self.connection.execute("SELECT * FROM job WHERE repository = ?", (repository,))
+        return {row["commit_sha"]: row for row in rows}
+
+    def mark(self, repository: str, commit: str, stage: str, status: str,
+             reason: Optional[str] = None, record: Optional[dict] = None):
+        self.mark_many([(repository, commit)], stage, status, reason, [record])
+
+    def mark_many(self, keys: list, stage: str, status: str, reason: Optional[str] = None, records: list = None):
+        if records is None:
+            records = [None] * len(keys)
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO job (repository, commit_sha, stage, status, reason, record, failures, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (repository, commit_sha) DO UPDATE SET
+                    stage = excluded.stage,
+                    status = excluded.status,
+                    reason = excluded.reason,
+                    record = COALESCE(excluded.record, job.record),
+                    failures = job.failures + excluded.failures,
+                    updated = excluded.updated
+                """,
+                [
+                    (repository, commit, stage, status, reason, json.dumps(record) if record is not None else None,
+                     int(status == FAILED), now)
+                    for (repository, commit), record in zip(keys, records)
+                ],
+            )
+
+    def failed_records(self) -> Iterator[dict]:
+        """The records of the items that failed after their parents were resolved."""
+        rows = self.connection.execute("SELECT record FROM job WHERE status = ? AND record IS NOT NULL ORDER BY repository, commit_sha", (FAILED,))
+        for row in rows.fetchall():
+            yield json.loads(row["record"])
+
+    def summary(self) -> str:
+        counts = self.connection.execute("SELECT stage, status, COUNT(*) FROM job GROUP BY stage, status ORDER BY stage, status")
+        return ", ".join(f"{stage} {status}: {count}" for stage, status, count in counts)
+
+def is_finished(state: Optional[sqlite3.Row]) -> bool:
+    return state is not None and (state["status"] == SKIPPED or (state["stage"] == PERSIST and state["status"] == DONE))
+
+def is_selected(state: Optional[sqlite3.Row], retry_failed: bool) -> bool:
+    """Whether an item should be worked on in this run: anything unfinished, and failed items only when retrying."""
+    if is_finished(state):
+        return False
+    return state is None or state["status"] != FAILED or retry_failed
+
+def add_ledger_args(parser):
+    parser.add_argument(
+        "--ledger",
+        action="store",
+        required=False,
+        default=LEDGER_FILE,
+        help="SQLite file tracking each commit's progress, shared by get_parents.py and automate_diffs.py."
+    )
+
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        required=False,
+        help="Also re-run the commits that failed in an earlier run; finished commits are still skipped."
+    )
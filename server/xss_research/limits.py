@@ -0,0 +1,119 @@
+import logging
+import os
+import resource
+import signal
+import subprocess
+import sys
+
+from typing import Optional, Union
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+DEFAULT_GIT_TIMEOUT = 600
+DEFAULT_SEMGREP_TIMEOUT = 3600
+DEFAULT_MAX_MEMORY_MB = 8192
+OUT_OF_MEMORY_MESSAGES = (b"out of memory", b"cannot allocate memory", b"memoryerror")
+
+class Limits:
+    """
+    The wall-clock and memory limits every git and semgrep subprocess of the
+    pipeline runs under, so one pathological repository is killed and
+    recorded instead of hanging a worker for good. The limits of the current
+    process are set once with `set_limits`, including in worker processes.
+    """
+
+    def __init__(self, git_timeout: Optional[float] = DEFAULT_GIT_TIMEOUT,
+                 semgrep_timeout: Optional[float] = DEFAULT_SEMGREP_TIMEOUT,
+                 max_memory_mb: Optional[int] = DEFAULT_MAX_MEMORY_MB):
+        self.git_timeout = git_timeout
+        self.semgrep_timeout = semgrep_timeout
+        self.max_memory_mb = max_memory_mb
+
+_limits = Limits()
+
+def set_limits(limits: Limits):
+    global _limits
+    _limits = limits
+
+def get_limits() -> Limits:
+    return _limits
+
+def kill_group(p: subprocess.Popen):
+    # semgrep and git both start children of their own, so the whole group goes.
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def run_limited(cmd: list, cwd: str, timeout: Optional[float], max_memory_mb: Optional[int],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, input: Optional[bytes] = None) -> Union[subprocess.CompletedProcess, str]:
+    """
+    Runs `cmd` in its own process group with at most `max_memory_mb` of address
+    space per process, killing the group after `timeout` seconds. Returns the
+    finished process, or a message saying which limit it hit.
+    """
+    def limit_memory():
+        if max_memory_mb:
+            limit = max_memory_mb * 1024 ** 2
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    # e.g. "git diff" or "semgrep", for the log and the ledger.
+    name = " ".join([os.path.basename(cmd[0])] + [arg for arg in cmd[1:] if not arg.startswith("-")][:1])
+    p = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE if input is not None else None, stdout=stdout, stderr=stderr,
+                         start_new_session=True, preexec_fn=limit_memory)
+    try:
+        out, err = p.communicate(input=input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_group(p)
+        p.communicate()
+        logger.info(f"Killed '{name}' in '{cwd}' after {timeout:g} seconds")
+        return f"'{name}' took longer than {timeout:g} seconds."
+    except BaseException:
+        kill_group(p)
+        p.wait()
+        raise
+    if p.returncode != 0 and max_memory_mb and err is not None and any(message in err.lower() for message in OUT_OF_MEMORY_MESSAGES):
+        logger.info(f"'{name}' in '{cwd}' ran out of memory")
+        return f"'{name}' used more than {max_memory_mb} MB of memory."
+    return subprocess.CompletedProcess(cmd, p.returncode, out, err)
+
+def is_limit_error(message) -> bool:
+    return type(message) == str and message.startswith("'") and (" took longer than " in message or " used more than " in message)
+
+def run_git(args: list, cwd: str, stdout=subprocess.PIPE, input: Optional[bytes] = None) -> Union[subprocess.CompletedProcess, str]:
+    return run_limited(["git"] + args, cwd, _limits.git_timeout, _limits.max_memory_mb, stdout=stdout, input=input)
+
+def add_limit_args(parser):
+    parser.add_argument(
+        "--git-timeout",
+        action="store",
+        type=float,
+        required=False,
+        default=DEFAULT_GIT_TIMEOUT,
+        help="Seconds a git diff or worktree checkout may take before the commit is recorded as failed."
+    )
+
+    parser.add_argument(
+        "--semgrep-timeout",
+        action="store",
+        type=float,
+        required=False,
+        default=DEFAULT_SEMGREP_TIMEOUT,
+        help="Seconds one semgrep run may take before its findings are recorded as failed."
+    )
+
+    parser.add_argument(
+        "--max-memory-mb",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_MAX_MEMORY_MB,
+        help="Memory each git and semgrep process may use; 0 for no limit."
+    )
+
+def limits_from_args(args) -> Limits:
+    return Limits(git_timeout=args.git_timeout, semgrep_timeout=args.semgrep_timeout, max_memory_mb=args.max_memory_mb)
@@ -0,0 +1,170 @@
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+from typing import Iterator, List, Optional
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+METRICS_FILE = "pipeline_metrics.ndjson"
+PERCENTILES = (50, 90, 99)
+SLOWEST_REPOS = 20
+
+# Every stage of the pipeline appends one JSON line per repository and stage,
+#   {"time", "pid", "stage", "repository", "wall", "cpu", ...counters}
+# where wall and cpu are seconds, cpu including the git and semgrep processes
+# the stage waited on, and counters are numbers such as "bytes" or "files".
+# Nothing is written until a script calls `set_metrics_file`.
+
+_path = None
+_file = None
+_pid = None
+
+def set_metrics_file(path: Optional[str]):
+    global _path, _file
+    _path = os.path.abspath(path) if path else None
+    _file = None
+
+def get_metrics_file() -> Optional[str]:
+    return _path
+
+def cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def emit(stage: str, repository: Optional[str] = None, **fields):
+    global _file, _pid
+    if _path is None:
+        return
+    if _file is None or _pid != os.getpid():
+        # one handle per process; appends of whole lines don't interleave.
+        _file = open(_path, 'a', buffering=1)
+        _pid = os.getpid()
+    event = {"time": time.time(), "pid": _pid, "stage": stage, "repository": repository}
+    event.update(fields)
+    _file.write(json.dumps(event) + "\n")
+
+@contextlib.contextmanager
+def timed(stage: str, repository: Optional[str] = None, **fields):
+    """Emits the wall and CPU time of the block; counters set on the yielded dict are emitted with them."""
+    start_wall = time.monotonic()
+    start_cpu = cpu_seconds()
+    try:
+        yield fields
+    finally:
+        emit(stage, repository, wall=time.monotonic() - start_wall, cpu=cpu_seconds() - start_cpu, **fields)
+
+def read_events(path: str) -> Iterator[dict]:
+    with open(path, 'r') as fin:
+        for line in fin:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # a line cut short by a run that was killed.
+                continue
+
+def percentile(values: List[float], p: float) -> float:
+    # nearest rank on sorted values.
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+def summarize(events, slowest: int = SLOWEST_REPOS) -> dict:
+    """Per-stage totals and percentiles, summed counters, the semgrep cache hit rate and the slowest repositories."""
+    walls = {}
+    stages = {}
+    repos = {}
+    for event in events:
+        stage = stages.setdefault(event["stage"], {"stage": event["stage"], "count": 0, "wall": 0.0, "cpu": 0.0, "counters": {}})
+        stage["count"] += 1
+        for key, value in event.items():
+            if key in ("time", "pid", "stage", "repository") or type(value) not in (int, float):
+                continue
+            if key == "wall":
+                walls.setdefault(event["stage"], []).append(value)
+                stage["wall"] += value
+                if event.get("repository"):
+                    repos[event["repository"]] = repos.get(event["repository"], 0.0) + value
+            elif key == "cpu":
+                stage["cpu"] += value
+            else:
+                stage["counters"][key] = stage["counters"].get(key, 0) + value
+    for name, stage in stages.items():
+        values = sorted(walls.get(name, []))
+        stage["percentiles"] = {p: percentile(values, p) for p in PERCENTILES}
+        stage["max"] = values[-1] if values else 0.0
+    cache = stages.get("semgrep cache", {}).get("counters", {})
+    hit_rate = cache["hits"] / cache["files"] if cache.get("files") else None
+    return {
+        "stages": sorted(stages.values(), key=lambda stage: -stage["wall"]),
+        "cache_hit_rate": hit_rate,
+        "slowest_repos": sorted(repos.items(), key=lambda item: -item[1])[:slowest],
+    }
+
+def format_summary(summary: dict) -> str:
+    lines = [f"{'stage':<16} {'count':>7} {'wall s':>10} {'cpu s':>10} " + " ".join(f"{'p' + str(p):>8}" for p in PERCENTILES) + f" {'max':>8}  counters"]
+    for stage in summary["stages"]:
+        counters = ", ".join(f"{key}={value:g}" for key, value in sorted(stage["counters"].items()))
+        percentiles = " ".join(f"{stage['percentiles'][p]:8.2f}" for p in PERCENTILES)
+        lines.append(f"{stage['stage']:<16} {stage['count']:>7} {stage['wall']:>10.1f} {stage['cpu']:>10.1f} {percentiles} {stage['max']:8.2f}  {counters}")
+    if summary["cache_hit_rate"] is not None:
+        lines.append(f"\nsemgrep cache hit rate: {summary['cache_hit_rate']:.1%}")
+    lines.append("\nslowest repositories (wall seconds across stages):")
+    for repository, wall in summary["slowest_repos"]:
+        lines.append(f"{wall:10.1f}  {repository}")
+    return "\n".join(lines)
+
+def add_metrics_args(parser):
+    parser.add_argument(
+        "--metrics",
+        action="store",
+        required=False,
+        default=METRICS_FILE,
+        help="JSON lines file the per-stage timings and counters are appended to; summarize it with metrics.py."
+    )
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Summarizes the timings and counters written by get_parents.py and
+            automate_diffs.py: percentiles per stage and the slowest repositories.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "-f",
+        "--file",
+        action="store",
+        required=False,
+        default=METRICS_FILE,
+        help="The metrics file to summarize."
+    )
+
+    args.add_argument(
+        "--top",
+        action="store",
+        type=int,
+        required=False,
+        default=SLOWEST_REPOS,
+        help="Number of slowest repositories to list."
+    )
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    print(format_summary(summarize(read_events(args.file), args.top)))
+
+if __name__ == "__main__":
+    main()
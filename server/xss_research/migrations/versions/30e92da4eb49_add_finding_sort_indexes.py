@@ -0,0 +1,29 @@
+"""Add indexes backing the sorting, filtering and keyset pagination of the index page
+
+Revision ID: 30e92da4eb49
+Revises: 2b03dab9f094
+Create Date: 2026-10-18 13:41:52.902317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '30e92da4eb49'
+down_revision = '2b03dab9f094'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the expressions must match models.sort_key exactly.
+    op.create_index('ix_finding_triage_status_id', 'finding', [sa.text("coalesce(triage_status, '')"), 'id'], unique=False)
+    op.create_index('ix_finding_taxonomy_id', 'finding', [sa.text("coalesce(taxonomy, '')"), 'id'], unique=False)
+    op.create_index('ix_finding_repo_url_id', 'finding', ['repo_url', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_finding_repo_url_id', table_name='finding')
+    op.drop_index('ix_finding_taxonomy_id', table_name='finding')
+    op.drop_index('ix_finding_triage_status_id', table_name='finding')
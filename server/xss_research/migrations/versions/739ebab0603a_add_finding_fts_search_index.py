@@ -0,0 +1,25 @@
+"""Add 'finding_fts' full-text search index over findings
+
+Revision ID: 739ebab0603a
+Revises: ea0f3b550ed7
+Create Date: 2026-10-18 17:05:43.218760
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '739ebab0603a'
+down_revision = 'ea0f3b550ed7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the index starts out empty; fill it with `python search.py --rebuild`.
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS finding_fts USING fts5(repo_message, diff_text, reviewer_notes, content='')")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS finding_fts")
@@ -0,0 +1,91 @@
+"""Move diff_text and semgrep_results_on_diff into a compressed, content-addressed blob table
+
+Revision ID: 7528c0e1f363
+Revises: 30e92da4eb49
+Create Date: 2026-10-18 14:37:10.663015
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import hashlib
+import zlib
+
+
+# revision identifiers, used by Alembic.
+revision = '7528c0e1f363'
+down_revision = '30e92da4eb49'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def blob_hash(text):
+    return hashlib.sha256(text.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def upgrade():
+    connection = op.get_bind()
+    # app.py's db.create_all() may have created the table already.
+    if 'blob' not in sa.inspect(connection).get_table_names():
+        op.create_table('blob',
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('hash')
+        )
+    op.add_column('finding', sa.Column('diff_hash', sa.String(length=64), nullable=True))
+    op.add_column('finding', sa.Column('semgrep_results_hash', sa.String(length=64), nullable=True))
+
+    last_id = -1
+    while True:
+        rows = connection.execute(sa.text(
+            "SELECT id, diff_text, semgrep_results_on_diff FROM finding WHERE id > :last_id ORDER BY id LIMIT :limit"
+        ), last_id=last_id, limit=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        blobs = {}
+        updates = []
+        for id, diff_text, semgrep_results_on_diff in rows:
+            hashes = []
+            for text in (diff_text, semgrep_results_on_diff):
+                if text is None:
+                    hashes.append(None)
+                    continue
+                hash = blob_hash(text)
+                if hash not in blobs:
+                    blobs[hash] = zlib.compress(text.encode('utf-8', 'surrogateescape'))
+                hashes.append(hash)
+            updates.append({"id": id, "diff_hash": hashes[0], "semgrep_results_hash": hashes[1]})
+        connection.execute(
+            sa.text("INSERT OR IGNORE INTO blob (hash, data) VALUES (:hash, :data)"),
+            [{"hash": hash, "data": data} for hash, data in blobs.items()],
+        )
+        connection.execute(
+            sa.text("UPDATE finding SET diff_hash = :diff_hash, semgrep_results_hash = :semgrep_results_hash WHERE id = :id"),
+            updates,
+        )
+        last_id = rows[-1][0]
+
+    # a plain ALTER TABLE DROP COLUMN (SQLite 3.35+) keeps the table's indexes
+    # and constraints, which batch mode would have to rebuild by hand.
+    op.drop_column('finding', 'semgrep_results_on_diff')
+    op.drop_column('finding', 'diff_text')
+
+
+def downgrade():
+    op.add_column('finding', sa.Column('diff_text', sa.Text(), nullable=True))
+    op.add_column('finding', sa.Column('semgrep_results_on_diff', sa.Text(), nullable=True))
+
+    connection = op.get_bind()
+    for column, hash_column in (('diff_text', 'diff_hash'), ('semgrep_results_on_diff', 'semgrep_results_hash')):
+        for hash, data in connection.execute(sa.text(
+            f"SELECT DISTINCT blob.hash, blob.data FROM blob JOIN finding ON finding.{hash_column} = blob.hash"
+        )).fetchall():
+            connection.execute(
+                sa.text(f"UPDATE finding SET {column} = :text WHERE {hash_column} = :hash"),
+                text=zlib.decompress(data).decode('utf-8', 'surrogateescape'), hash=hash,
+            )
+
+    op.drop_column('finding', 'semgrep_results_hash')
+    op.drop_column('finding', 'diff_hash')
+    op.drop_table('blob')
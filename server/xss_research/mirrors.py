@@ -0,0 +1,210 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from typing import Iterable, Optional
+from gitobjects import close_repository, repository
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+MIRROR_DIRECTORY = "mirrors"
+REMOTE_BASE_URL = "https://github.com/"
+# mirrors used more recently than this are never evicted, so one process can't
+# delete a mirror another stage or worker is still reading from.
+EVICTION_GRACE_SECONDS = 60 * 60
+
+class MirrorCache:
+    """
+    A cache of bare, blobless mirrors shared by every stage of the pipeline.
+    Mirrors are addressed by a hash of their remote URL, so `get_parents.py` and
+    `automate_diffs.py` resolve a repository to the same directory. Blobs are
+    fetched lazily by git when a diff or worktree needs them, and commits that
+    are missing from a mirror are fetched on demand.
+    """
+
+    def __init__(self, root: str = MIRROR_DIRECTORY, remote_base: str = REMOTE_BASE_URL,
+                 max_bytes: Optional[int] = None, shallow: bool = False, timeout: Optional[float] = None):
+        self.root = os.path.abspath(root)
+        self.remote_base = remote_base.rstrip("/") + "/"
+        self.max_bytes = max_bytes
+        self.shallow = shallow
+        self.timeout = timeout
+
+    def remote_url(self, repo_name: str) -> str:
+        return self.remote_base + repo_name + ".git"
+
+    def path_for(self, repo_name: str) -> str:
+        key = hashlib.sha256(self.remote_url(repo_name).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], key + ".git")
+
+    def has_commit(self, path: str, commit: str) -> bool:
+        return repository(path).resolve(commit) is not None
+
+    def git(self, args: list, cwd: str) -> bool:
+        try:
+            p = subprocess.run(["git"] + args, cwd=cwd, capture_output=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            logger.info(f"'git {args[0]}' in '{cwd}' took too long")
+            return False
+        if p.returncode != 0:
+            logger.info(f"'git {args[0]}' in '{cwd}' returned an error: {p.stderr.decode('utf-8', 'replace').strip()}")
+            return False
+        return True
+
+    def clone(self, repo_name: str, path: str, commits: list) -> bool:
+        git_url = self.remote_url(repo_name)
+        logger.info(f"Mirroring repo '{git_url}'")
+        # clone next to the final path and rename, so a half-finished clone is never used.
+        tmp_path = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{os.path.basename(path)}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.shallow and commits:
+            ok = (self.git(["init", "--bare", "--quiet", tmp_path], cwd=self.root)
+                and self.git(["remote", "add", "origin", git_url], cwd=tmp_path)
+                and self.git(["fetch", "--quiet", "--filter=blob:none", "--depth=2", "origin"] + list(commits), cwd=tmp_path))
+        else:
+            ok = self.git(["clone", "--quiet", "--bare", "--filter=blob:none", git_url, tmp_path], cwd=self.root)
+        if not ok:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return False
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished the same clone first.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return True
+
+    def fetch(self, path: str, commits: list) -> bool:
+        logger.info(f"Fetching {len(commits)} missing commit(s) into '{path}'")
+        depth = ["--depth=2"] if self.shallow else []
+        fetch = ["fetch", "--quiet", "--filter=blob:none"] + depth + ["origin"]
+        if self.git(fetch + list(commits), cwd=path):
+            return True
+        if len(commits) == 1:
+            return False
+        # one unknown commit fails the whole fetch, so retry them one at a time.
+        fetched_all = True
+        for commit in commits:
+            fetched_all = self.git(fetch + [commit], cwd=path) and fetched_all
+        return fetched_all
+
+    def ensure(self, repo_name: str, commits: Iterable[str] = ()) -> Optional[str]:
+        """
+        Returns the path of a mirror of `repo_name` with as many of `commits`
+        as could be fetched, or None if the repository couldn't be cloned. A
+        commit that doesn't exist (any more) only fails itself, so callers
+        check for the commits they need.
+        """
+        commits = [c for c in commits if c]
+        path = self.path_for(repo_name)
+        if not os.path.exists(path):
+            if not self.clone(repo_name, path, commits):
+                return None
+            self.evict()
+        missing = [c for c in commits if not self.has_commit(path, c)]
+        if missing and not self.fetch(path, missing):
+            logger.info(f"Some of {len(missing)} commit(s) couldn't be fetched into '{path}'")
+        # the mirror's mtime is its last-used time for eviction.
+        os.utime(path, None)
+        return path
+
+    def mirrors(self):
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                if name.endswith(".git") and not name.startswith(".tmp-"):
+                    yield os.path.join(prefix_path, name)
+
+    def evict(self):
+        """Deletes the least recently used mirrors until the cache fits in `max_bytes`."""
+        if self.max_bytes is None or not os.path.exists(self.root):
+            return
+        entries = []
+        for path in self.mirrors():
+            entries.append((os.stat(path).st_mtime, directory_size(path), path))
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for last_used, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if now - last_used < EVICTION_GRACE_SECONDS:
+                logger.info("Mirror cache is over its size limit, but every remaining mirror is in use.")
+                break
+            logger.info(f"Evicting mirror '{path}' ({size} bytes)")
+            close_repository(path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+def directory_size(path: str) -> int:
+    size = 0
+    for dirpath, subdirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(dirpath, file)).st_size
+            except OSError:
+                pass
+    return size
+
+def add_mirror_args(parser):
+    parser.add_argument(
+        "--remote-base",
+        action="store",
+        required=False,
+        default=REMOTE_BASE_URL,
+        help="Base URL repositories are cloned from, e.g. 'file:///tmp/repos/' for local testing."
+    )
+
+    parser.add_argument(
+        "--mirror-directory",
+        action="store",
+        required=False,
+        default=MIRROR_DIRECTORY,
+        help="Directory holding the mirror cache shared by get_parents.py and automate_diffs.py."
+    )
+
+    parser.add_argument(
+        "--mirror-max-gb",
+        action="store",
+        type=float,
+        required=False,
+        default=None,
+        help="Evict least recently used mirrors once the cache grows past this size."
+    )
+
+    parser.add_argument(
+        "--shallow",
+        action="store_true",
+        required=False,
+        help="Fetch only the commits being analyzed and their parents instead of the whole history."
+    )
+
+    parser.add_argument(
+        "--clone-timeout",
+        action="store",
+        type=float,
+        required=False,
+        default=600,
+        help="Seconds a clone or fetch may take before the repository is skipped."
+    )
+
+def mirror_cache_from_args(args) -> MirrorCache:
+    max_bytes = None
+    if args.mirror_max_gb is not None:
+        max_bytes = int(args.mirror_max_gb * 1024 ** 3)
+    return MirrorCache(
+        root=args.mirror_directory,
+        remote_base=args.remote_base,
+        max_bytes=max_bytes,
+        shallow=args.shallow,
+        timeout=args.clone_timeout,
+    )
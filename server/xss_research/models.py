@@ -1,6 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
 from database import db
+from hunks import index_diff_files
 import enum
+import hashlib
+import zlib
 
 class TriageStatus(enum.Enum):
     unreviewed = 0
@@ -16,13 +21,243 @@ class Taxonomy(enum.Enum):
     E = "👎 XSS not detected"
 
 class Finding(db.Model):
+    __table_args__ = (
+        db.Index("ix_finding_repo_url_fix_commit", "repo_url", "fix_commit", unique=True),
+    )
+
     id = db.Column(db.Integer(), primary_key=True)
     repo_url = db.Column(db.String(1024))
     repo_message = db.Column(db.Text())
     fix_commit = db.Column(db.String(512))
     previous_commit = db.Column(db.String(512))
-    diff_text = db.Column(db.Text())
-    semgrep_results_on_diff = db.Column(db.Text())
+    # the diff and semgrep's output are stored once per distinct content in
+    # the blob table; see blob_property.
+    diff_hash = db.Column(db.String(64))
+    semgrep_results_hash = db.Column(db.String(64))
+    # the SHA-256 of the ruleset file the finding was scanned with, see rulesets.py.
+    ruleset_hash = db.Column(db.String(64), index=True)
     triage_status = db.Column(db.Enum(TriageStatus))
     taxonomy = db.Column(db.Enum(Taxonomy))
     reviewer_notes = db.Column(db.Text())
+    # the stable patch id of the fix, see dedup.py. Findings of an equivalent
+    # fix elsewhere (a fork, a mirror, a cherry-pick) aren't analyzed again but
+    # point at the finding that was, and share its triage.
+    patch_id = db.Column(db.String(64), index=True)
+    canonical_id = db.Column(db.Integer(), db.ForeignKey("finding.id"), index=True)
+    duplicates = db.relationship("Finding", backref=db.backref("canonical", remote_side=[id]), order_by="Finding.id")
+    matches = db.relationship("SemgrepMatch", backref="finding", cascade="all, delete-orphan",
+        order_by="(SemgrepMatch.path, SemgrepMatch.start_line)")
+    diff_files = db.relationship("DiffFile", backref="finding", cascade="all, delete-orphan",
+        order_by="DiffFile.position")
+
+class Blob(db.Model):
+    """
+    zlib-compressed text addressed by the sha256 of its content, so the same
+    diff stored for a fork, a re-run or a merged database is only kept once.
+    """
+    hash = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary(), nullable=False)
+
+def blob_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8', 'surrogateescape')).hexdigest()
+
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode('utf-8', 'surrogateescape'))
+
+def decompress_text(data: bytes) -> str:
+    return zlib.decompress(data).decode('utf-8', 'surrogateescape')
+
+def blob_property(hash_column: str):
+    """
+    A text attribute kept in the blob table under the hash in `hash_column`.
+    It is only fetched and decompressed when read; setting it queues the
+    blob to be inserted when the session flushes.
+    """
+    cached = f"_{hash_column}_text"
+
+    def get(self):
+        if cached not in self.__dict__:
+            text = None
+            hash = getattr(self, hash_column)
+            if hash is not None:
+                session = object_session(self) or db.session
+                data = session.query(Blob.data).filter(Blob.hash == hash).scalar()
+                text = decompress_text(data) if data is not None else None
+            self.__dict__[cached] = text
+        return self.__dict__[cached]
+
+    def set(self, text):
+        self.__dict__[cached] = text
+        if text is None:
+            setattr(self, hash_column, None)
+            return
+        hash = blob_hash(text)
+        setattr(self, hash_column, hash)
+        self.__dict__.setdefault("_pending_blobs", {})[hash] = compress_text(text)
+
+    return property(get, set)
+
+Finding.diff_text = blob_property("diff_hash")
+Finding.semgrep_results_on_diff = blob_property("semgrep_results_hash")
+
+@event.listens_for(Session, "before_flush")
+def insert_pending_blobs(session, flush_context, instances):
+    # blobs stay queued on their object, so a flush retried after a rollback
+    # inserts them again.
+    pending = {}
+    for obj in list(session.new) + list(session.dirty):
+        pending.update(obj.__dict__.get("_pending_blobs", {}))
+    if pending:
+        # a blob that is already stored is left alone.
+        session.execute(
+            Blob.__table__.insert().prefix_with("OR IGNORE"),
+            [{"hash": hash, "data": data} for hash, data in pending.items()],
+        )
+
+# A contentless FTS5 index over each finding's text, with the finding's id as
+# rowid. It stores no copy of the (large) texts, so snippets are built from the
+# findings themselves (see search.py), and a row must be deleted with exactly
+# the values it was indexed with.
+FINDING_FTS_COLUMNS = ("repo_message", "diff_text", "reviewer_notes")
+FINDING_FTS_SCHEMA = f"CREATE VIRTUAL TABLE IF NOT EXISTS finding_fts USING fts5({', '.join(FINDING_FTS_COLUMNS)}, content='')"
+
+def create_finding_fts(connection):
+    connection.execute(FINDING_FTS_SCHEMA)
+
+def index_finding_fts(connection, id: int, values: tuple, delete: bool = False):
+    columns = ", ".join(FINDING_FTS_COLUMNS)
+    placeholders = ", ".join(f":{column}" for column in FINDING_FTS_COLUMNS)
+    params = dict(zip(FINDING_FTS_COLUMNS, values), id=id)
+    if delete:
+        connection.execute(db.text(f"INSERT INTO finding_fts (finding_fts, rowid, {columns}) VALUES ('delete', :id, {placeholders})"), params)
+    else:
+        connection.execute(db.text(f"INSERT INTO finding_fts (rowid, {columns}) VALUES (:id, {placeholders})"), params)
+
+def indexed_fts_values(finding, session) -> tuple:
+    """The values `finding` had before this flush, i.e. what it's indexed with."""
+    state = inspect(finding)
+    values = []
+    for column in FINDING_FTS_COLUMNS:
+        attribute = "diff_hash" if column == "diff_text" else column
+        history = state.attrs[attribute].history
+        if not history.has_changes():
+            values.append(getattr(finding, column))
+        elif column == "diff_text":
+            old_hash = history.deleted[0] if history.deleted else None
+            data = session.query(Blob.data).filter(Blob.hash == old_hash).scalar()
+            values.append(decompress_text(data) if data is not None else None)
+        else:
+            values.append(history.deleted[0] if history.deleted else None)
+    return tuple(values)
+
+@event.listens_for(Session, "after_flush")
+def sync_finding_fts(session, flush_context):
+    connection = session.connection()
+    for finding in session.new:
+        if isinstance(finding, Finding):
+            index_finding_fts(connection, finding.id, tuple(getattr(finding, column) for column in FINDING_FTS_COLUMNS))
+    for finding in list(session.dirty) + list(session.deleted):
+        if not isinstance(finding, Finding):
+            continue
+        state = inspect(finding)
+        deleted = finding in session.deleted
+        changed = [state.attrs["diff_hash" if column == "diff_text" else column].history.has_changes() for column in FINDING_FTS_COLUMNS]
+        if not deleted and not any(changed):
+            continue
+        # findings stored before the index existed are only added by a rebuild.
+        if connection.execute(db.text("SELECT rowid FROM finding_fts WHERE rowid = :id"), id=finding.id).first() is None:
+            continue
+        index_finding_fts(connection, finding.id, indexed_fts_values(finding, session), delete=True)
+        if not deleted:
+            index_finding_fts(connection, finding.id, tuple(getattr(finding, column) for column in FINDING_FTS_COLUMNS))
+
+class DiffFile(db.Model):
+    """Where one changed file's diff is in its finding's diff_text, with its line stats."""
+    id = db.Column(db.Integer(), primary_key=True)
+    finding_id = db.Column(db.Integer(), db.ForeignKey("finding.id"), nullable=False, index=True)
+    position = db.Column(db.Integer(), nullable=False)
+    path = db.Column(db.String(4096))
+    old_path = db.Column(db.String(4096))
+    start = db.Column(db.Integer(), nullable=False)
+    length = db.Column(db.Integer(), nullable=False)
+    additions = db.Column(db.Integer(), nullable=False)
+    deletions = db.Column(db.Integer(), nullable=False)
+
+    @classmethod
+    def from_diff(cls, diff_text: str) -> list:
+        return [cls(**file) for file in index_diff_files(diff_text)]
+
+class SemgrepMatch(db.Model):
+    id = db.Column(db.Integer(), primary_key=True)
+    finding_id = db.Column(db.Integer(), db.ForeignKey("finding.id"), nullable=False, index=True)
+    rule_id = db.Column(db.String(512), nullable=False, index=True)
+    path = db.Column(db.String(4096), nullable=False)
+    start_line = db.Column(db.Integer())
+    end_line = db.Column(db.Integer())
+    severity = db.Column(db.String(32))
+    message = db.Column(db.Text())
+    # in_hunk, near_hunk or unrelated to the lines the fix changed; see hunks.py.
+    relevance = db.Column(db.String(16), index=True)
+
+    @classmethod
+    def from_semgrep_result(cls, result: dict) -> "SemgrepMatch":
+        extra = result.get("extra", {})
+        return cls(
+            rule_id=result["check_id"],
+            path=result["path"],
+            start_line=result["start"]["line"],
+            end_line=result["end"]["line"],
+            severity=extra.get("severity"),
+            message=extra.get("message"),
+            relevance=result.get("relevance"),
+        )
+
+class FrameworkLabel(db.Model):
+    """
+    The framework of a fix commit according to one label file, imported by
+    framework_labels.py. A commit can be labeled by several files; the one
+    with the lowest precedence wins, and override rows (the round 2 updates)
+    also replace the finding's triage status. Commits without a label of
+    their own take the first label of their repository.
+    """
+    repo_url = db.Column(db.String(1024), primary_key=True)
+    fix_commit = db.Column(db.String(512), primary_key=True)
+    source = db.Column(db.String(256), primary_key=True)
+    precedence = db.Column(db.Integer(), nullable=False)
+    # the row of the label in its file, which orders a repository's labels.
+    position = db.Column(db.Integer(), nullable=False)
+    overrides = db.Column(db.Boolean(), nullable=False, default=False)
+    framework = db.Column(db.String(64), index=True)
+    triage_status = db.Column(db.String(32))
+    note = db.Column(db.Text())
+
+db.Index("ix_framework_label_repo_url_overrides", FrameworkLabel.repo_url, FrameworkLabel.overrides,
+    FrameworkLabel.precedence, FrameworkLabel.position)
+
+def finding_framework():
+    """The framework of the finding in the enclosing query: its commit's label, else its repository's."""
+    commit_label = db.select([FrameworkLabel.framework]).where(db.and_(
+        FrameworkLabel.repo_url == Finding.repo_url,
+        FrameworkLabel.fix_commit == Finding.fix_commit,
+    )).order_by(FrameworkLabel.precedence).limit(1).as_scalar()
+    repo_label = db.select([FrameworkLabel.framework]).where(db.and_(
+        FrameworkLabel.repo_url == Finding.repo_url,
+        FrameworkLabel.overrides == False,
+    )).order_by(FrameworkLabel.precedence, FrameworkLabel.position).limit(1).as_scalar()
+    return db.func.coalesce(commit_label, repo_label)
+
+def sort_key(column):
+    # NULLs can't be compared in a keyset, so they sort as ''. The expression
+    # must match the indexes below exactly for SQLite to use them.
+    return db.func.coalesce(db.type_coerce(column, db.String), db.literal_column("''"))
+
+# the columns the index page can sort by, each backed by an index on (key, id).
+FINDING_SORT_KEYS = {
+    "triage_status": sort_key(Finding.triage_status),
+    "taxonomy": sort_key(Finding.taxonomy),
+    "repo": Finding.repo_url,
+}
+
+db.Index("ix_finding_triage_status_id", FINDING_SORT_KEYS["triage_status"], Finding.id)
+db.Index("ix_finding_taxonomy_id", FINDING_SORT_KEYS["taxonomy"], Finding.id)
+db.Index("ix_finding_repo_url_id", Finding.repo_url, Finding.id)
@@ -0,0 +1,43 @@
+import json
+import sys
+
+from typing import Iterator
+
+# Commit records are handed from get_parents.py to automate_diffs.py as
+# newline-delimited JSON, one {"repository", "commit", "parent", "message"}
+# object per line, so the second stage can consume them while the first is
+# still producing them. Records may also carry "changed_files", the number of
+# files the commit touched, used to schedule expensive commits first, and
+# "patch_id", added by dedup.py, which marks equivalent fixes in different
+# repositories so only one of them is analyzed.
+# "-" means stdin/stdout.
+
+def open_output(path: str):
+    if path == "-":
+        return sys.stdout
+    return open(path, 'w')
+
+def write_record(fout, record: dict):
+    fout.write(json.dumps(record) + "\n")
+    fout.flush()
+
+def read_records(path: str) -> Iterator[dict]:
+    fin = sys.stdin if path == "-" else open(path, 'r')
+    with fin:
+        first_line = fin.readline()
+        if not first_line.strip():
+            return
+        try:
+            record = json.loads(first_line)
+        except ValueError:
+            record = None
+        if record is None or ("columns" in record and "data" in record):
+            # the pandas orient="split" table written by older versions of get_parents.py
+            table = json.loads(first_line + fin.read())
+            for values in table["data"]:
+                yield dict(zip(table["columns"], values))
+            return
+        yield record
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
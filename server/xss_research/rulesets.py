@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import requests
+import yaml
+
+from typing import Optional
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+PACK_URL = "https://semgrep.dev/c/p/xss"
+RULESET_DIRECTORY = "rulesets"
+FETCH_TIMEOUT = 30
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def ruleset_hash(path: str) -> str:
+    with open(path, 'rb') as fin:
+        return content_hash(fin.read())
+
+def validate(content: bytes) -> Optional[str]:
+    """Returns why `content` isn't a usable semgrep ruleset, or None if it is."""
+    try:
+        ruleset = yaml.safe_load(content)
+    except yaml.YAMLError as e:
+        return f"not YAML: {e}"
+    if not isinstance(ruleset, dict) or not isinstance(ruleset.get("rules"), list) or not ruleset["rules"]:
+        return "no 'rules' list"
+    for rule in ruleset["rules"]:
+        if not isinstance(rule, dict) or "id" not in rule or "languages" not in rule:
+            return "a rule without an 'id' or 'languages'"
+    return None
+
+class RulesetStore:
+    """
+    Content-addressed copies of every ruleset the pipeline has scanned with,
+    named by their SHA-256, so a finding's ruleset hash always points at the
+    exact rules that produced it. An index remembers each URL's latest
+    version with its ETag and Last-Modified for conditional revalidation, and
+    an optional pinned version that runs use instead of the network.
+    """
+
+    def __init__(self, root: str = RULESET_DIRECTORY):
+        self.root = os.path.abspath(root)
+        self.index_path = os.path.join(self.root, "index.json")
+
+    def path_for(self, hash: str) -> str:
+        return os.path.join(self.root, hash + ".yaml")
+
+    def load_index(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {"urls": {}, "versions": [], "pinned": None}
+        with open(self.index_path, 'r') as fin:
+            return json.load(fin)
+
+    def save_index(self, index: dict):
+        os.makedirs(self.root, exist_ok=True)
+        # written next to the index and renamed, so a crash never leaves half of it.
+        with tempfile.NamedTemporaryFile('w', dir=self.root, delete=False) as fout:
+            json.dump(index, fout, indent=2)
+        os.replace(fout.name, self.index_path)
+
+    def add(self, content: bytes, source: str) -> str:
+        """Stores a validated copy of `content` and returns its hash."""
+        problem = validate(content)
+        if problem is not None:
+            raise ValueError(f"Ruleset from '{source}' is invalid: {problem}")
+        hash = content_hash(content)
+        path = self.path_for(hash)
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=self.root, delete=False) as fout:
+                fout.write(content)
+            os.replace(fout.name, path)
+        index = self.load_index()
+        if not any(version["hash"] == hash for version in index["versions"]):
+            index["versions"].append({"hash": hash, "source": source, "added": time.time()})
+            self.save_index(index)
+        return hash
+
+    def resolve(self, pin: str) -> str:
+        """The hash of a stored version named by a hash or a unique hash prefix, or of a local file, which is stored."""
+        if os.path.isfile(pin):
+            with open(pin, 'rb') as fin:
+                content = fin.read()
+            try:
+                return self.add(content, os.path.abspath(pin))
+            except ValueError as e:
+                raise SystemExit(str(e))
+        matches = [version["hash"] for version in self.load_index()["versions"] if version["hash"].startswith(pin)]
+        if len(matches) != 1 or not os.path.exists(self.path_for(matches[0])):
+            raise SystemExit(f"'{pin}' is neither a ruleset file nor {'a unique' if matches else 'a'} stored ruleset version.")
+        return matches[0]
+
+    def fetch(self, url: str, offline: bool = False) -> str:
+        """
+        The hash of the current version of `url`. Online, the stored version
+        is revalidated with a conditional request; offline, or when the request
+        fails, the last stored version is used as is.
+        """
+        index = self.load_index()
+        known = index["urls"].get(url)
+        if known is not None and not os.path.exists(self.path_for(known["hash"])):
+            known = None
+        if offline:
+            if known is None:
+                raise SystemExit(f"No stored version of '{url}' to run offline with; fetch it once or pass a ruleset file.")
+            return known["hash"]
+
+        headers = {}
+        if known is not None:
+            if known.get("etag"):
+                headers["If-None-Match"] = known["etag"]
+            if known.get("last_modified"):
+                headers["If-Modified-Since"] = known["last_modified"]
+        try:
+            response = requests.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+            if response.status_code == 304 and known is not None:
+                logger.info(f"Ruleset '{url}' is unchanged ({known['hash'][:12]})")
+                return known["hash"]
+            response.raise_for_status()
+            hash = self.add(response.content, url)
+        except (requests.RequestException, ValueError) as e:
+            if known is None:
+                raise SystemExit(f"Couldn't fetch ruleset '{url}' and no version of it is stored: {e}")
+            logger.info(f"Couldn't fetch ruleset '{url}', using the stored version {known['hash'][:12]}: {e}")
+            return known["hash"]
+
+        if known is None or known["hash"] != hash:
+            logger.info(f"Ruleset '{url}' is now version {hash[:12]}")
+        index = self.load_index()
+        index["urls"][url] = {
+            "hash": hash,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked": time.time(),
+        }
+        self.save_index(index)
+        return hash
+
+    def pin(self, hash: Optional[str]):
+        index = self.load_index()
+        index["pinned"] = hash
+        self.save_index(index)
+
+    def current(self, url: str, pin: Optional[str] = None, offline: bool = False) -> str:
+        """The hash a run scans with: an explicit pin, else the store's pinned version, else `url`'s current version."""
+        if pin is not None:
+            return self.resolve(pin)
+        index = self.load_index()
+        pinned = index.get("pinned")
+        if pinned is not None:
+            # a pin edited by hand, or whose file was pruned, would only fail inside semgrep.
+            if not any(version["hash"] == pinned for version in index["versions"]) or not os.path.exists(self.path_for(pinned)):
+                raise SystemExit(f"The pinned ruleset '{pinned}' isn't stored in '{self.root}'; pin another version with --pin, or --pin none.")
+            return pinned
+        return self.fetch(url, offline)
+
+def add_ruleset_args(parser):
+    parser.add_argument(
+        "--ruleset",
+        action="store",
+        required=False,
+        default=None,
+        help="Scan with this ruleset: a local file, or the hash (or a prefix of it) of a stored version. Overrides the store's pinned version."
+    )
+
+    parser.add_argument(
+        "--ruleset-url",
+        action="store",
+        required=False,
+        default=PACK_URL,
+        help="Where the ruleset is revalidated from when no version is pinned."
+    )
+
+    parser.add_argument(
+        "--ruleset-directory",
+        action="store",
+        required=False,
+        default=RULESET_DIRECTORY,
+        help="Directory holding the stored ruleset versions."
+    )
+
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        required=False,
+        help="Never touch the network for the ruleset; use the last stored version."
+    )
+
+def ruleset_from_args(args) -> str:
+    """The path of the ruleset file a run scans with."""
+    store = RulesetStore(args.ruleset_directory)
+    return store.path_for(store.current(args.ruleset_url, args.ruleset, args.offline))
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Manages the stored semgrep ruleset versions: lists them, fetches
+            the current version of a URL, adds local files and pins the
+            version runs use.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "--ruleset-directory",
+        action="store",
+        required=False,
+        default=RULESET_DIRECTORY,
+        help="Directory holding the stored ruleset versions."
+    )
+
+    args.add_argument(
+        "--fetch",
+        action="store",
+        nargs="?",
+        const=PACK_URL,
+        required=False,
+        help="Fetch (or revalidate) the ruleset at a URL, the XSS pack by default."
+    )
+
+    args.add_argument(
+        "--add",
+        action="store",
+        required=False,
+        help="Store a local ruleset file."
+    )
+
+    args.add_argument(
+        "--pin",
+        action="store",
+        required=False,
+        help="Make runs use this stored version (hash or prefix) without touching the network; 'none' unpins."
+    )
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    store = RulesetStore(args.ruleset_directory)
+    if args.fetch:
+        print(store.fetch(args.fetch))
+    if args.add:
+        print(store.resolve(args.add))
+    if args.pin:
+        store.pin(None if args.pin == "none" else store.resolve(args.pin))
+    index = store.load_index()
+    for version in index["versions"]:
+        pinned = " (pinned)" if version["hash"] == index.get("pinned") else ""
+        added = time.strftime("%Y-%m-%d %H:%M", time.localtime(version["added"]))
+        print(f"{version['hash'][:12]}  {added}  {version['source']}{pinned}")
+
+if __name__ == "__main__":
+    main()
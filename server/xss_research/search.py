@@ -0,0 +1,139 @@
+import argparse
+import html
+import logging
+import re
+import sys
+
+from markupsafe import Markup
+from sqlalchemy.exc import OperationalError
+from database import db
+from models import FINDING_FTS_COLUMNS, Finding, index_finding_fts
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+SEARCH_LIMIT = 25
+SNIPPET_CONTEXT = 80
+REBUILD_BATCH_SIZE = 200
+FTS_OPERATORS = {"AND", "OR", "NOT", "NEAR"}
+
+def quoted_query(query: str) -> str:
+    # every word as a literal string, for input that isn't valid FTS5 syntax.
+    return " ".join('"' + term + '"' for term in re.findall(r"\w+", query))
+
+def query_terms(query: str) -> list:
+    return [term for term in re.findall(r"\w+", query) if term not in FTS_OPERATORS]
+
+def matching_ids(query: str, limit: int = SEARCH_LIMIT) -> list:
+    """Ids of the findings matching an FTS5 query, best match first."""
+    sql = db.text("SELECT rowid FROM finding_fts WHERE finding_fts MATCH :query ORDER BY bm25(finding_fts) LIMIT :limit")
+    try:
+        return [id for id, in db.session.execute(sql, {"query": query, "limit": limit})]
+    except OperationalError:
+        db.session.rollback()
+        query = quoted_query(query)
+        if not query:
+            return []
+        return [id for id, in db.session.execute(sql, {"query": query, "limit": limit})]
+
+def snippet(text: str, terms: list, context: int = SNIPPET_CONTEXT):
+    """The text around the first term found in `text`, HTML-escaped with every term marked, or None."""
+    if not text or not terms:
+        return None
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(text)
+    if first is None:
+        return None
+    start = max(0, first.start() - context)
+    end = min(len(text), first.end() + context)
+    window = text[start:end]
+    parts = []
+    last = 0
+    for match in pattern.finditer(window):
+        parts.append(html.escape(window[last:match.start()]))
+        parts.append("<mark>" + html.escape(match.group(0)) + "</mark>")
+        last = match.end()
+    parts.append(html.escape(window[last:]))
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    return Markup(prefix + "".join(parts) + suffix)
+
+def search_findings(query: str, limit: int = SEARCH_LIMIT) -> list:
+    ids = matching_ids(query, limit)
+    findings = {finding.id: finding for finding in Finding.query.filter(Finding.id.in_(ids))}
+    terms = query_terms(query)
+    results = []
+    for id in ids:
+        finding = findings.get(id)
+        if finding is None:
+            continue
+        snippets = {}
+        for column in FINDING_FTS_COLUMNS:
+            text = snippet(getattr(finding, column), terms)
+            if text is not None:
+                snippets[column] = text
+        results.append({"finding": finding, "snippets": snippets})
+    return results
+
+def rebuild(batch_size: int = REBUILD_BATCH_SIZE):
+    """Re-indexes every finding, e.g. for databases that predate the index."""
+    connection = db.session.connection()
+    connection.execute(db.text("INSERT INTO finding_fts (finding_fts) VALUES ('delete-all')"))
+    last_id = -1
+    indexed = 0
+    while True:
+        findings = Finding.query.filter(Finding.id > last_id).order_by(Finding.id).limit(batch_size).all()
+        if not findings:
+            break
+        for finding in findings:
+            index_finding_fts(connection, finding.id, tuple(getattr(finding, column) for column in FINDING_FTS_COLUMNS))
+        last_id = findings[-1].id
+        indexed += len(findings)
+        # don't keep every decompressed diff in memory.
+        db.session.expunge_all()
+        logger.info(f"Indexed {indexed} findings")
+    connection.execute(db.text("INSERT INTO finding_fts (finding_fts) VALUES ('optimize')"))
+    db.session.commit()
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Maintains the full-text search index over findings' commit
+            messages, diffs and reviewer notes.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "--rebuild",
+        action="store_true",
+        required=False,
+        help="Index every finding from scratch."
+    )
+
+    args.add_argument(
+        "-q",
+        "--query",
+        action="store",
+        required=False,
+        help="Print the findings matching a search."
+    )
+
+    return args.parse_args()
+
+def main() -> None:
+    from app import app
+
+    args = parse_args()
+    with app.app_context():
+        if args.rebuild:
+            rebuild()
+        if args.query:
+            for result in search_findings(args.query):
+                print(result["finding"].id, result["finding"].repo_url, result["finding"].fix_commit)
+
+if __name__ == "__main__":
+    main()
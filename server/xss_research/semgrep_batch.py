@@ -0,0 +1,121 @@
+import logging
+import os
+import sys
+
+from typing import List
+from semgrep_cache import SemgrepCache, run_semgrep, target_key
+from metrics import timed
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_BATCH_MAX_BYTES = 512 * 1024 ** 2
+
+class SemgrepBatch:
+    """
+    Collects findings whose files aren't in the semgrep cache yet and scans
+    all of them with one semgrep run, instead of paying semgrep's startup and
+    rule compilation once per finding. Every finding's worktree lives under
+    `root`, so a match is attributed back to its finding by the worktree
+    prefix of its path.
+
+    A finding is a dict with "targets" ({path: blob}) and "worktree_path";
+    `add` and `flush` return [(finding, results)] for the findings they finish.
+    """
+
+    def __init__(self, cache: SemgrepCache, rules: List[dict], root: str,
+                 max_findings: int = DEFAULT_BATCH_SIZE, max_bytes: int = DEFAULT_BATCH_MAX_BYTES):
+        self.cache = cache
+        self.rules = rules
+        self.root = os.path.abspath(root)
+        self.max_findings = max_findings
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.pending_bytes = 0
+
+    def add(self, finding: dict) -> list:
+        if finding["worktree_path"] is None:
+            # everything is cached already.
+            return [(finding, self.cache.results(finding["targets"], self.rules))]
+        self.pending.append(finding)
+        self.pending_bytes += finding["scan_bytes"]
+        if len(self.pending) >= self.max_findings or self.pending_bytes >= self.max_bytes:
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        if not self.pending:
+            return []
+        # batch path -> (index of the finding, path inside its repository), grouped
+        # by the rules the file is missing so each group is one semgrep run.
+        groups = {}
+        # scheduled keys -> indexes of every finding waiting on them.
+        scheduled = {}
+        for index, finding in enumerate(self.pending):
+            prefix = os.path.relpath(finding["worktree_path"], self.root)
+            for path, missing_rules in self.cache.missing_rules(finding["targets"], self.rules).items():
+                blob = finding["targets"][path]
+                keys = tuple((target_key(rule, path, blob), rule["hash"]) for rule in missing_rules)
+                if keys in scheduled:
+                    # the same content is already being scanned for another finding.
+                    scheduled[keys].append(index)
+                    continue
+                scheduled[keys] = [index]
+                group = groups.setdefault(tuple(rule["hash"] for rule in missing_rules), (missing_rules, {}))
+                group[1][os.path.join(prefix, path)] = (index, path, keys)
+
+        logger.info(f"Scanning {len(scheduled)} file(s) of {len(self.pending)} finding(s) in {len(groups)} semgrep run(s)")
+        errors = {}
+        # index -> [(path, reason)] of the files semgrep couldn't scan.
+        skipped = {}
+        for missing_rules, owners in groups.values():
+            # one run covers many repositories, so it isn't attributed to any of them.
+            with timed("semgrep", findings=len(self.pending), files=len(owners), rules=len(missing_rules)):
+                results = run_semgrep(missing_rules, self.root, list(owners))
+            if type(results) == str:
+                for index, path, keys in owners.values():
+                    for waiting_index in scheduled[keys]:
+                        errors[waiting_index] = results
+                continue
+            results, failed = results
+            # a file semgrep couldn't scan isn't recorded, so it's scanned again
+            # next time, and every finding waiting on it fails instead of
+            # looking like it had no matches there.
+            for batch_path, reason in failed.items():
+                if batch_path not in owners:
+                    continue
+                index, path, keys = owners[batch_path]
+                for waiting_index in scheduled[keys]:
+                    skipped.setdefault(waiting_index, []).append((path, reason))
+            results_by_finding = {}
+            for result in results:
+                if result["path"] in failed:
+                    continue
+                index, path, keys = owners[result["path"]]
+                result["path"] = path
+                results_by_finding.setdefault(index, []).append(result)
+            scanned_by_finding = {}
+            for batch_path, (index, path, keys) in owners.items():
+                if batch_path in failed:
+                    continue
+                scanned_by_finding.setdefault(index, {})[path] = self.pending[index]["targets"][path]
+            for index, targets in scanned_by_finding.items():
+                self.cache.record(targets, missing_rules, results_by_finding.get(index, []))
+
+        for index, files in skipped.items():
+            listed = ", ".join(f"'{path}' ({reason})" for path, reason in sorted(files))
+            errors.setdefault(index, f"semgrep couldn't scan {len(files)} file(s): {listed}")
+
+        finished = []
+        for index, finding in enumerate(self.pending):
+            if index in errors:
+                finished.append((finding, errors[index]))
+            else:
+                finished.append((finding, self.cache.results(finding["targets"], self.rules)))
+        self.pending = []
+        self.pending_bytes = 0
+        return finished
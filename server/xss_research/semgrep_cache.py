@@ -0,0 +1,205 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import yaml
+
+from typing import Dict, List, Tuple, Union
+from limits import get_limits, run_limited
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+SEMGREP_CACHE_FILE = "semgrep_cache.db"
+# keeps semgrep's command line well under the OS argument length limit.
+MAX_TARGETS_PER_RUN = 500
+EXTENSION_GLOB = re.compile(r"^\*\.[\w.-]+$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scanned (
+    target TEXT NOT NULL,
+    rule_hash TEXT NOT NULL,
+    PRIMARY KEY (target, rule_hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS match (
+    target TEXT NOT NULL,
+    rule_hash TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS match_target_rule ON match (target, rule_hash);
+"""
+
+def rule_hash(rule: dict) -> str:
+    return hashlib.sha256(json.dumps(rule, sort_keys=True).encode('utf-8')).hexdigest()
+
+def keyed_by_path(rule: dict) -> bool:
+    # semgrep picks a file's language from its extension, so a blob's matches
+    # only depend on the extension -- unless the rule filters on paths with
+    # anything other than extension globs like '*.html'.
+    paths = rule.get("paths", {})
+    patterns = paths.get("include", []) + paths.get("exclude", [])
+    return any(not EXTENSION_GLOB.match(pattern) for pattern in patterns)
+
+_rules_cache = {}
+
+def load_rules(ruleset_file: str) -> List[dict]:
+    """Returns [{"id", "hash", "by_path", "rule"}] for every rule in a ruleset file."""
+    mtime = os.stat(ruleset_file).st_mtime
+    cached = _rules_cache.get(ruleset_file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(ruleset_file, 'r') as fin:
+        ruleset = yaml.safe_load(fin)
+    rules = []
+    for rule in ruleset.get("rules", []):
+        rules.append({
+            "id": rule["id"],
+            "hash": rule_hash(rule),
+            "by_path": keyed_by_path(rule),
+            "rule": rule,
+        })
+    _rules_cache[ruleset_file] = (mtime, rules)
+    return rules
+
+def target_key(rule: dict, path: str, blob: str) -> str:
+    if rule["by_path"]:
+        return f"{blob}:{path}"
+    return f"{blob}:{os.path.splitext(path)[1]}"
+
+class SemgrepCache:
+    """
+    Persistent per-file semgrep matches keyed by (git blob, rule content hash).
+    A (blob, rule) pair that was scanned is recorded even if it didn't match,
+    so only blobs that were never scanned with a rule's current content are
+    sent to semgrep again; editing one rule only invalidates that rule.
+    """
+
+    def __init__(self, path: str = SEMGREP_CACHE_FILE):
+        self.path = os.path.abspath(path)
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        # connections can't cross into worker processes; each opens its own.
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    def rows_for(self, table: str, columns: str, path: str, blob: str, rules: List[dict]):
+        keys = list({target_key(rule, path, blob) for rule in rules})
+        placeholders = ", ".join("?" * len(keys))
+        return self.connection.execute(f"SELECT target, {columns} FROM {table} WHERE target IN ({placeholders})", keys)
+
+    def missing_rules(self, targets: Dict[str, str], rules: List[dict]) -> Dict[str, List[dict]]:
+        """Maps each target path to the rules it hasn't been scanned with yet."""
+        missing = {}
+        for path, blob in targets.items():
+            scanned = set(self.rows_for("scanned", "rule_hash", path, blob, rules))
+            unscanned = [rule for rule in rules if (target_key(rule, path, blob), rule["hash"]) not in scanned]
+            if unscanned:
+                missing[path] = unscanned
+        return missing
+
+    def record(self, targets: Dict[str, str], rules: List[dict], results: List[dict]):
+        """Stores the results of scanning `targets` with `rules`, including the absence of matches."""
+        rules_by_id = {rule["id"]: rule for rule in rules}
+        with self.connection:
+            for path, blob in targets.items():
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO scanned (target, rule_hash) VALUES (?, ?)",
+                    [(target_key(rule, path, blob), rule["hash"]) for rule in rules],
+                )
+                # a rescan replaces whatever an earlier, interrupted scan left behind.
+                self.connection.executemany(
+                    "DELETE FROM match WHERE target = ? AND rule_hash = ?",
+                    [(target_key(rule, path, blob), rule["hash"]) for rule in rules],
+                )
+            for result in results:
+                rule = rules_by_id[result["check_id"]]
+                blob = targets[result["path"]]
+                stored = {k: v for k, v in result.items() if k != "path"}
+                self.connection.execute(
+                    "INSERT INTO match (target, rule_hash, result) VALUES (?, ?, ?)",
+                    (target_key(rule, result["path"], blob), rule["hash"], json.dumps(stored)),
+                )
+
+    def results(self, targets: Dict[str, str], rules: List[dict]) -> List[dict]:
+        results = []
+        for path, blob in targets.items():
+            wanted = {(target_key(rule, path, blob), rule["hash"]) for rule in rules}
+            for target, matched_rule_hash, result in self.rows_for("match", "rule_hash, result", path, blob, rules):
+                if (target, matched_rule_hash) in wanted:
+                    result = json.loads(result)
+                    result["path"] = path
+                    results.append(result)
+        results.sort(key=lambda result: (result["path"], result["start"]["line"], result["check_id"]))
+        return results
+
+def run_semgrep(rules: List[dict], cwd: str, paths: List[str]) -> Union[Tuple[List[dict], Dict[str, str]], str]:
+    """
+    Runs semgrep with only `rules` on `paths` (relative to `cwd`) and returns
+    its results and the paths it couldn't scan, with semgrep's reason. Those
+    have no (or only partial) results, so they must not be cached as scanned.
+    """
+    # rules are renamed to their hash so results can be attributed no matter
+    # how semgrep prefixes rule ids with the config file's location.
+    rules_by_hash_id = {"r" + rule["hash"][:32]: rule for rule in rules}
+    ruleset = {"rules": [dict(rule["rule"], id=hash_id) for hash_id, rule in rules_by_hash_id.items()]}
+    with tempfile.NamedTemporaryFile('w', suffix=".yaml", delete=False) as fout:
+        yaml.safe_dump(ruleset, fout)
+        config_path = fout.name
+    try:
+        results = []
+        failed = {}
+        for start in range(0, len(paths), MAX_TARGETS_PER_RUN):
+            chunk = paths[start:start + MAX_TARGETS_PER_RUN]
+            limits = get_limits()
+            # semgrep skips the files it can't scan within --max-memory and only
+            # lists them in its errors, which are returned as failed below; the
+            # address space limit kills it if it grows past that anyway.
+            memory = ["--max-memory", str(limits.max_memory_mb)] if limits.max_memory_mb else []
+            p = run_limited(["semgrep", "--json", "--config", config_path] + memory + chunk, cwd,
+                            limits.semgrep_timeout, limits.max_memory_mb)
+            if type(p) == str:
+                return p
+            if p.returncode != 0:
+                logger.info(f"semgrep returned {p.returncode}: {p.stderr.decode('utf-8', 'replace').strip()[-1000:]}")
+                return "semgrep run returned an error."
+            try:
+                output = json.loads(p.stdout.decode('utf-8'))
+            except (UnicodeDecodeError, ValueError):
+                return "semgrep run returned an error."
+            paths_by_normpath = {os.path.normpath(path): path for path in chunk}
+            for error in output.get("errors", []):
+                # errors about a single file (syntax errors, timeouts, memory)
+                # come with its path; semgrep still exits with 0 for them.
+                if error.get("path") is not None:
+                    path = paths_by_normpath.get(os.path.normpath(error["path"]), error["path"])
+                    reason = error.get("type", "error")
+                    if reason == "Out of memory" and limits.max_memory_mb:
+                        reason = f"more than {limits.max_memory_mb} MB of memory"
+                    failed[path] = reason
+            for result in output.get("results", []):
+                result["check_id"] = rules_by_hash_id[result["check_id"].rsplit(".", 1)[-1]]["id"]
+                result["path"] = paths_by_normpath.get(os.path.normpath(result["path"]), result["path"])
+                results.append(result)
+        return results, failed
+    finally:
+        os.unlink(config_path)
@@ -0,0 +1,290 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import yaml
+import pandas as pd
+
+from typing import List, Optional, Set
+from urllib.parse import urlparse
+from app import app
+from analysis import LABEL_KEY, label_findings, load_labeled_findings
+from database import db
+from models import Finding, SemgrepMatch
+from hunks import IN_HUNK, NEAR_HUNK, classify_results
+from limits import add_limit_args, limits_from_args, set_limits
+from mirrors import MirrorCache, add_mirror_args, mirror_cache_from_args
+from rulesets import RULESET_DIRECTORY, RulesetStore, ruleset_hash
+from semgrep_cache import SEMGREP_CACHE_FILE, SemgrepCache, load_rules
+from semgrep_batch import DEFAULT_BATCH_MAX_BYTES, DEFAULT_BATCH_SIZE, SemgrepBatch
+from util import WORKTREE_DIRECTORY
+from automate_diffs import finish_prepared_row, prepare_rows_in_parallel, prepare_rows_serially
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+def affected_rule_ids(rules_a: List[dict], rules_b: List[dict]) -> Set[str]:
+    """Ids of the rules that were added, removed or changed between two rulesets."""
+    hashes_a = {rule["id"]: rule["hash"] for rule in rules_a}
+    hashes_b = {rule["id"]: rule["hash"] for rule in rules_b}
+    return {id for id in set(hashes_a) | set(hashes_b) if hashes_a.get(id) != hashes_b.get(id)}
+
+def write_rules(rules: List[dict], path: str):
+    with open(path, 'w') as fout:
+        yaml.safe_dump({"rules": [rule["rule"] for rule in rules]}, fout)
+
+def stored_findings() -> pd.DataFrame:
+    with app.app_context():
+        rows = db.session.query(Finding.id, Finding.repo_url, Finding.fix_commit, Finding.previous_commit, Finding.triage_status,
+                                Finding.canonical_id, Finding.ruleset_hash).all()
+    return pd.DataFrame(
+        [(id, repo_url, fix_commit, previous_commit, triage_status.name if triage_status else None, canonical_id, ruleset_hash)
+         for id, repo_url, fix_commit, previous_commit, triage_status, canonical_id, ruleset_hash in rows],
+        columns=["finding_id", "repo_url", "fix_commit", "previous_commit", "triage_status", "canonical_id", "ruleset_hash"],
+    )
+
+def baseline_detected(affected: Set[str], baseline_hash: str) -> Set[int]:
+    """
+    Findings a rule that didn't change matched on or near the fix; they're
+    detected by both versions. Only findings scanned with the baseline ruleset
+    itself count, since other versions' matches say nothing about it.
+    """
+    with app.app_context():
+        query = db.session.query(SemgrepMatch.finding_id).join(Finding, SemgrepMatch.finding_id == Finding.id).filter(
+            # duplicates have no matches of their own; they take their canonical finding's.
+            Finding.canonical_id.is_(None),
+            Finding.ruleset_hash == baseline_hash,
+            SemgrepMatch.rule_id.notin_(sorted(affected)),
+            # matches stored before they were classified count as well.
+            db.or_(SemgrepMatch.relevance.in_([IN_HUNK, NEAR_HUNK]), SemgrepMatch.relevance.is_(None)),
+        ).distinct()
+        return {finding_id for finding_id, in query}
+
+def scan_with(findings: pd.DataFrame, ruleset_file: str, mirrors: MirrorCache, cache: SemgrepCache, jobs: int,
+              batch_size: int, batch_max_bytes: int) -> Set[int]:
+    """Findings that the rules of `ruleset_file` match on or near the fix."""
+    rows = []
+    for finding in findings.itertuples(index=False):
+        rows.append({
+            "repository": urlparse(finding.repo_url).path.strip("/"),
+            "commit": finding.fix_commit,
+            "parent": [finding.previous_commit],
+            "message": "",
+            "finding_id": finding.finding_id,
+        })
+    # matches away from the changed files are never near the fix, so only those are scanned.
+    if jobs > 1:
+        prepared_rows = prepare_rows_in_parallel(rows, True, mirrors, cache, jobs, ruleset_file)
+    else:
+        prepared_rows = prepare_rows_serially(rows, True, mirrors, cache, ruleset_file)
+    batch = SemgrepBatch(cache, load_rules(ruleset_file), WORKTREE_DIRECTORY, batch_size, batch_max_bytes)
+
+    detected = set()
+    def record(prepared, results):
+        if type(results) == str:
+            return
+        if classify_results(results, prepared["hunks"]):
+            detected.add(prepared["row"]["finding_id"])
+
+    for prepared in prepared_rows:
+        if prepared["failure"] is not None or type(prepared["targets"]) == str:
+            reason = prepared["failure"][1] if prepared["failure"] is not None else prepared["targets"]
+            logger.info(f"Couldn't rescan '{prepared['row']['repository']}' commit '{prepared['row']['commit']}': {reason}")
+            continue
+        for finished, results in batch.add(prepared):
+            record(*finish_prepared_row(finished, results))
+    for finished, results in batch.flush():
+        record(*finish_prepared_row(finished, results))
+    return detected
+
+def sweep(ruleset_a: str, ruleset_b: str, mirrors: MirrorCache, cache: SemgrepCache, jobs: int = 1,
+          batch_size: int = DEFAULT_BATCH_SIZE, batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES) -> pd.DataFrame:
+    """Every stored finding with whether each ruleset detects it."""
+    rules_a = load_rules(ruleset_a)
+    rules_b = load_rules(ruleset_b)
+    affected = affected_rule_ids(rules_a, rules_b)
+    findings = stored_findings()
+    # only the analyzed finding of each group of equivalent fixes is rescanned,
+    # so the forks dedup.py skipped are never cloned for a sweep.
+    canonical = findings[findings["canonical_id"].isna()]
+    # the stored matches stand for ruleset a only where a produced them; the
+    # rest are rescanned with every rule of both versions.
+    baseline_hash = ruleset_hash(ruleset_a)
+    current = canonical[canonical["ruleset_hash"] == baseline_hash]
+    stale = canonical[canonical["ruleset_hash"] != baseline_hash]
+    # a duplicate is detected whenever its canonical finding is.
+    scanned_id = findings["canonical_id"].fillna(findings["finding_id"]).astype(int)
+    baseline = baseline_detected(affected, baseline_hash)
+    if len(stale):
+        logger.info(f"{len(stale)} finding(s) were scanned with another ruleset; rescanning them with all rules")
+    if not affected:
+        logger.info("The rulesets have the same rules")
+        if len(stale):
+            baseline |= scan_with(stale, ruleset_a, mirrors, cache, jobs, batch_size, batch_max_bytes)
+        findings["detected_a"] = findings["detected_b"] = scanned_id.isin(baseline)
+        return findings
+    logger.info(f"{len(affected)} rule(s) changed; rescanning {len(current)} finding(s) with only those")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for column, ruleset, rules in (("detected_a", ruleset_a, rules_a), ("detected_b", ruleset_b, rules_b)):
+            path = os.path.join(directory, column + ".yaml")
+            changed = [rule for rule in rules if rule["id"] in affected]
+            detected = set(baseline)
+            if changed and len(current):
+                write_rules(changed, path)
+                detected |= scan_with(current, path, mirrors, cache, jobs, batch_size, batch_max_bytes)
+            if len(stale):
+                detected |= scan_with(stale, ruleset, mirrors, cache, jobs, batch_size, batch_max_bytes)
+            findings[column] = scanned_id.isin(detected)
+    return findings
+
+def label_sweep(findings: pd.DataFrame, labels_directory: Optional[str] = None) -> pd.DataFrame:
+    """The swept findings with their framework, from the labels imported with framework_labels.py unless `labels_directory` is given."""
+    if labels_directory is not None:
+        return label_findings(findings, labels_directory)
+    with app.app_context():
+        db_file = db.engine.url.database
+    labeled = load_labeled_findings(db_file)
+    return labeled.merge(findings[LABEL_KEY + ["detected_a", "detected_b"]].drop_duplicates(LABEL_KEY), on=LABEL_KEY)
+
+def status_counts(m: pd.DataFrame, column: str) -> pd.DataFrame:
+    # the notebook's `p`: fixes per framework and detected (true_positive) or missed (false_negative).
+    status = m[column].map({True: "true_positive", False: "false_negative"}).rename("triage_status")
+    return m.assign(triage_status=status).groupby(["framework", "triage_status"]).agg({"fix_commit": "count"})
+
+DELTA_COLUMNS = ["% a", "% b", "N", "newly detected", "newly missed", "delta"]
+
+def delta_table(m: pd.DataFrame) -> pd.DataFrame:
+    # the notebook's `y` for both versions: detection rate and N per framework, and what changed.
+    if m.empty:
+        return pd.DataFrame(columns=DELTA_COLUMNS, index=pd.Index([], name="framework"))
+    detected_a = m["detected_a"].astype(bool)
+    detected_b = m["detected_b"].astype(bool)
+    y = pd.DataFrame({
+        "% a": detected_a.groupby(m["framework"]).mean(),
+        "% b": detected_b.groupby(m["framework"]).mean(),
+        "N": m.groupby("framework")["fix_commit"].count(),
+        "newly detected": (~detected_a & detected_b).groupby(m["framework"]).sum(),
+        "newly missed": (detected_a & ~detected_b).groupby(m["framework"]).sum(),
+    })
+    y["delta"] = y["% b"] - y["% a"]
+    return y.sort_values(by="% b", ascending=False)
+
+def parse_args():
+    args = argparse.ArgumentParser(
+        description="""
+            Re-evaluates every stored finding against two versions of the
+            ruleset, rescanning only the rules that differ, and prints the
+            per-framework detection rate of each with the commits that are
+            newly detected or newly missed.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    args.add_argument(
+        "ruleset_a",
+        help="The baseline ruleset: a file, or the hash (or prefix) of a stored version."
+    )
+
+    args.add_argument(
+        "ruleset_b",
+        help="The ruleset to compare against it."
+    )
+
+    args.add_argument(
+        "--ruleset-directory",
+        action="store",
+        required=False,
+        default=RULESET_DIRECTORY,
+        help="Directory holding the stored ruleset versions."
+    )
+
+    args.add_argument(
+        "--labels-directory",
+        action="store",
+        required=False,
+        default=None,
+        help="Join the label CSVs in this directory by repository instead of the labels imported with framework_labels.py."
+    )
+
+    args.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of worker processes preparing commits in parallel."
+    )
+
+    args.add_argument(
+        "--batch-size",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of findings whose files are scanned together in one semgrep run."
+    )
+
+    args.add_argument(
+        "--batch-max-mb",
+        action="store",
+        type=float,
+        required=False,
+        default=DEFAULT_BATCH_MAX_BYTES / 1024 ** 2,
+        help="Scan a batch early once the files waiting to be scanned add up to this many megabytes."
+    )
+
+    args.add_argument(
+        "--semgrep-cache",
+        action="store",
+        required=False,
+        default=SEMGREP_CACHE_FILE,
+        help="SQLite file caching semgrep matches per file blob and rule, shared with automate_diffs.py."
+    )
+
+    args.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        required=False,
+        help="Also write every finding whose detection changed to this CSV file."
+    )
+
+    add_mirror_args(args)
+    add_limit_args(args)
+
+    return args.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    set_limits(limits_from_args(args))
+    store = RulesetStore(args.ruleset_directory)
+    ruleset_a = store.path_for(store.resolve(args.ruleset_a))
+    ruleset_b = store.path_for(store.resolve(args.ruleset_b))
+    findings = sweep(ruleset_a, ruleset_b, mirror_cache_from_args(args), SemgrepCache(args.semgrep_cache), args.jobs,
+                     args.batch_size, int(args.batch_max_mb * 1024 ** 2))
+
+    changed = findings[findings.detected_a != findings.detected_b]
+    m = label_sweep(findings, args.labels_directory)
+    if m.empty:
+        logger.info("None of the swept findings is a labeled fix of a framework of interest")
+    pd.set_option("display.width", 200)
+    print("a:")
+    print(status_counts(m, "detected_a").unstack("triage_status", fill_value=0))
+    print("\nb:")
+    print(status_counts(m, "detected_b").unstack("triage_status", fill_value=0))
+    print()
+    print(delta_table(m))
+    print(f"\n{(~changed.detected_a).sum()} finding(s) newly detected, {changed.detected_a.sum()} newly missed:")
+    for finding in changed.itertuples(index=False):
+        print(f"{'+' if finding.detected_b else '-'} {finding.repo_url} {finding.fix_commit}")
+    if args.output:
+        changed.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+    main()
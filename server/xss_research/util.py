@@ -1,8 +1,13 @@
+import hashlib
 import logging
 import os
+import shutil
 import subprocess
 import sys
-from contextlib import contextmanager
+
+from gitobjects import repository
+from limits import run_git
+from metrics import timed
 
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.DEBUG)
@@ -10,26 +15,68 @@ handler = logging.StreamHandler(stream=sys.stderr)
 handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger.addHandler(handler)
 
-# cf. https://stackoverflow.com/a/37996581
-@contextmanager
-def cwd(path: str):
-    oldpwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(oldpwd)
-
-@contextmanager
-def git_checkout(commit: str):
-    p = subprocess.run(["git", "--no-pager", "rev-parse", "HEAD"], capture_output=True)
-    oldcommit = p.stdout.decode('utf-8').strip()
-    logger.debug(f"Saving old commit: {oldcommit}")
-
-    logger.debug(f"Checking out commit: {commit}")
-    subprocess.run(["git", "checkout", commit])
-    try:
-        yield
-    finally:
-        logger.debug(f"Returning to commit: {oldcommit}")
-        subprocess.run(["git", "checkout", oldcommit])
\ No newline at end of file
+WORKTREE_DIRECTORY = "worktrees"
+
+class WorktreeManager:
+    """
+    Materializes commits of a repository into disposable `git worktree`
+    directories, so commits can be scanned without touching the repository's
+    own working tree or the process' current directory. A worktree is reused
+    for as long as the manager lives and removed when it is closed.
+    """
+
+    def __init__(self, repo_path: str, root: str = WORKTREE_DIRECTORY, name: str = None):
+        self.repo_path = os.path.abspath(repo_path)
+        # what the repository is called in the pipeline's metrics.
+        self.name = name or self.repo_path
+        repo_key = hashlib.sha1(self.repo_path.encode('utf-8')).hexdigest()[:16]
+        self.root = os.path.join(os.path.abspath(root), repo_key)
+        self.worktrees = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def resolve(self, commit: str) -> str:
+        return repository(self.repo_path).resolve(commit)
+
+    def checkout(self, commit: str) -> str:
+        """Returns the path of a worktree at `commit`, or None if it couldn't be created."""
+        sha = self.resolve(commit)
+        if sha is None:
+            logger.info(f"Commit '{commit}' does not exist in '{self.repo_path}'")
+            return None
+        if sha in self.worktrees:
+            return self.worktrees[sha]
+
+        path = os.path.join(self.root, sha)
+        if os.path.exists(path):
+            # left over from a run that didn't clean up after itself.
+            self.remove_path(path)
+        os.makedirs(self.root, exist_ok=True)
+        logger.debug(f"Creating worktree for commit {sha}: {path}")
+        # checking out a huge tree is the slow part, so it runs under the git limits.
+        with timed("checkout", self.name):
+            p = run_git(["worktree", "add", "--detach", path, sha], self.repo_path)
+        if type(p) == str:
+            self.remove_path(path)
+            return None
+        if p.returncode != 0:
+            logger.info(f"git worktree add returned an error: {p.stderr.decode('utf-8', 'replace').strip()}")
+            return None
+        self.worktrees[sha] = path
+        return path
+
+    def remove_path(self, path: str):
+        p = subprocess.run(["git", "worktree", "remove", "--force", path], cwd=self.repo_path, capture_output=True)
+        if p.returncode != 0:
+            shutil.rmtree(path, ignore_errors=True)
+            subprocess.run(["git", "worktree", "prune"], cwd=self.repo_path, capture_output=True)
+
+    def close(self):
+        for sha, path in self.worktrees.items():
+            logger.debug(f"Removing worktree for commit {sha}: {path}")
+            self.remove_path(path)
+        self.worktrees = {}